@@ -81,5 +81,5 @@ if [ $? -ne 0 ]; then
 fi
 
 sudo pip install fs pyyaml sandboxlib requests
-sudo pip install jsonschema bottle cherrypy riemann-client
+sudo pip install jsonschema bottle cherrypy riemann-client scandir
 sudo pip install pep8
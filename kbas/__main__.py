@@ -15,20 +15,37 @@
 #
 # =*= License: GPL-2 =*=
 
+import errno
+import fcntl
+import hashlib
+import json
 import os
 import re
-import glob
 import shutil
-from time import strftime, gmtime
+import struct
+import tarfile
+import threading
+import zlib
+import requests
+from time import strftime, gmtime, sleep
 from datetime import datetime
 import tempfile
 from bottle import Bottle, request, response, template, static_file
-from subprocess import call
+from bottle import ServerAdapter
+from subprocess import Popen, PIPE
 
-from ybd import app, cache
+from ybd import app, cache, utils
+from kbas import index
 
 bottle = Bottle()
 
+# set after each upload, to wake the culler
+uploaded = threading.Event()
+
+# artifacts being fetched from upstream-url, and the Fetch for each
+fetching = {}
+fetching_lock = threading.Lock()
+
 
 class KeyedBinaryArtifactServer(object):
 
@@ -42,12 +59,25 @@ class KeyedBinaryArtifactServer(object):
             os.path.join(os.path.dirname(__file__), 'config', 'kbas.conf')])
         app.config['start-time'] = datetime.now()
         app.config['last-upload'] = datetime.now()
+        index.bootstrap()
+        if app.config.get('max-gigabytes') or \
+                app.config.get('min-free-gigabytes'):
+            culler = threading.Thread(target=cull_forever)
+            culler.daemon = True
+            culler.start()
 
-        try:
-            import cherrypy
-            server = 'cherrypy'
-        except:
-            server = 'wsgiref'
+        server = app.config.get('server', 'auto')
+        options = {}
+        if server == 'auto':
+            try:
+                import cherrypy
+                server = 'cherrypy'
+            except ImportError:
+                server = 'wsgiref'
+        if server == 'wsgiref':
+            server = ThreadedWSGIRefServer
+        if server == 'gunicorn':
+            options['workers'] = app.config.get('workers', 4)
 
         # for development:
         if app.config.get('mode') == 'development':
@@ -55,7 +85,7 @@ class KeyedBinaryArtifactServer(object):
                        port=app.config['port'], debug=True, reloader=True)
         else:
             bottle.run(server=server, host=app.config['host'],
-                       port=app.config['port'], reloader=True)
+                       port=app.config['port'], **options)
 
     @bottle.get('/static/<filename>')
     def send_static(filename):
@@ -66,20 +96,18 @@ class KeyedBinaryArtifactServer(object):
     @bottle.get('/<name>')
     @bottle.get('/artifacts/<name>')
     def list(name=""):
-        names = glob.glob(os.path.join(app.config['artifact-dir'],
-                          '*' + name + '*'))
-        try:
-            content = [[strftime('%y-%m-%d', gmtime(os.stat(x).st_atime)),
-                       cache.check(os.path.basename(x)),
-                       os.path.basename(x)] for x in names]
-        except:
-            content = [['--------',
-                       cache.check(os.path.basename(x)),
-                       os.path.basename(x)] for x in names]
+        page = max(1, request.query.get('page', 1, type=int))
+        size = app.config.get('page-size', 1000)
+        content = []
+        if re.match('^[a-zA-Z0-9\.\-\_]*$', name):
+            for key, _, checksum, _, accessed in index.find(
+                    name, (page - 1) * size, size):
+                content += [[strftime('%y-%m-%d', gmtime(accessed)),
+                             checksum or '', key]]
 
         return template('kbas',
-                        title='Available Artifacts:',
-                        content=reversed(sorted(content)),
+                        title='Available Artifacts (page %s):' % page,
+                        content=content,
                         css='static/style.css')
 
     @bottle.get('/1.0/artifacts')
@@ -87,17 +115,88 @@ class KeyedBinaryArtifactServer(object):
         f = request.query.filename
         return static_file(f, root=app.config['artifact-dir'], download=True)
 
-    @bottle.get('/get/<cache_id>')
+    @bottle.post('/1.0/artifacts')
+    def post_artifacts_query():
+        '''Given a JSON list of cache keys, say which artifacts we have.'''
+
+        # read the body ourselves: request.json refuses anything bigger than
+        # bottle's MEMFILE_MAX, which is only about a thousand keys
+        limit = int(app.config.get('max-query-bytes', 16 * 1024 * 1024))
+        body = request.body.read(limit + 1)
+        if len(body) > limit:
+            response.status = 413  # request entity too large
+            return
+        try:
+            keys = json.loads(body)
+        except ValueError:
+            keys = None
+        if not isinstance(keys, list) or \
+                not all(isinstance(key, basestring) for key in keys):
+            response.status = 400  # bad request, expected a list of keys
+            return
+
+        # answer from the index, so nothing here touches the artifacts. the
+        # checksum is left out if the index doesn't know it yet
+        result = {}
+        found = index.lookup(keys)
+        for cache_id in keys:
+            if cache_id not in found:
+                result[cache_id] = {'present': False}
+                continue
+            size, checksum = found[cache_id]
+            result[cache_id] = {'present': True, 'size': size}
+            if checksum:
+                result[cache_id]['checksum'] = checksum
+
+        missing = [cache_id for cache_id, info in result.items()
+                   if not info['present'] and
+                   re.match('^[a-zA-Z0-9\.\-\_]*$', cache_id)]
+        if app.config.get('upstream-url') and missing:
+            # anything upstream has, we can get
+            result.update(cache.remote_artifacts(
+                missing, app.config['upstream-url']) or {})
+        return result
+
+    @bottle.route('/get/<cache_id>', method=['GET', 'HEAD'])
     def get_artifact(cache_id):
+        if app.config.get('upstream-url') and \
+                re.match('^[a-zA-Z0-9\.\-\_]*$', cache_id) and \
+                not os.path.isdir(os.path.join(app.config['artifact-dir'],
+                                               cache_id)):
+            if request.method == 'HEAD':
+                # say what a GET would give, without fetching anything
+                found = upstream_headers(cache_id)
+                if found:
+                    length, checksum = found
+                    if length is not None:
+                        response.set_header('Content-Length', str(length))
+                    if checksum:
+                        response.set_header('X-Checksum', checksum)
+                    response.content_type = 'application/octet-stream'
+                    return ''
+            else:
+                fetch = Fetch.start(cache_id)
+                if fetch.partial:
+                    return fetch.serve()
+
         f = os.path.join(cache_id, cache_id)
-        return static_file(f, root=app.config['artifact-dir'], download=True)
+        result = static_file(f, root=app.config['artifact-dir'],
+                             download=True)
+        if result.status_code in [200, 206]:
+            # so clients can check the whole artifact, even if they resume
+            checksum = cache.check(cache_id)
+            result.set_header('X-Checksum', checksum)
+            if request.method == 'GET':
+                # cache.check() gives all '=' if it can't read the artifact
+                index.touch(cache_id, checksum.strip('=') and checksum)
+        return result
 
     @bottle.get('/')
     @bottle.get('/status')
     def status():
         stat = os.statvfs(app.config['artifact-dir'])
         free = stat.f_frsize * stat.f_bavail / 1000000000
-        artifacts = len(os.listdir(app.config['artifact-dir']))
+        artifacts = index.count()
         started = app.config['start-time'].strftime('%y-%m-%d %H:%M:%S')
         last_upload = app.config['last-upload'].strftime('%y-%m-%d %H:%M:%S')
         content = [['Started:', started]]
@@ -105,7 +204,10 @@ class KeyedBinaryArtifactServer(object):
         if app.config.get('last-reject'):
             content += [['Last reject:', app.config['last-reject']]]
         content += [['Space:', str(free) + 'GB']]
+        content += [['Used:', str(int(index.size()) / 1000000000) + 'GB']]
         content += [['Artifacts:', str(artifacts)]]
+        if app.config.get('upstream-url'):
+            content += [['Upstream:', app.config['upstream-url']]]
         return template('kbas',
                         title='KBAS status',
                         content=content,
@@ -113,62 +215,509 @@ class KeyedBinaryArtifactServer(object):
 
     @bottle.post('/upload')
     def post_artifact():
-        if app.config['password'] is 'insecure' or \
-                request.forms.get('password') != app.config['password']:
-            print 'Upload attempt: password fail'
-            app.config['last-reject'] = \
-                datetime.now().strftime('%y-%m-%d %H:%M:%S')
+        if not authorised(request.forms.get('password')):
             response.status = 401  # unauthorized
             return
 
-        cache_id = request.forms.get('filename')
-        if re.match('^[a-zA-Z0-9\.\-\_]*$', cache_id) is None:
-            response.status = 400  # bad request, cache_id contains bad things
+        upload = request.files.get('file')
+        response.status = store(request.forms.get('filename'), upload.file,
+                                None, request.forms.get('checksum', 'XYZ'))
+
+    @bottle.put('/upload/<cache_id>')
+    def put_artifact(cache_id):
+        if not authorised(request.get_header('X-Password')):
+            response.status = 401  # unauthorized
             return
 
-        if os.path.isdir(os.path.join(app.config['artifact-dir'], cache_id)):
-            if cache.check(cache_id) == request.forms.get('checksum', 'XYZ'):
-                response.status = 777  # this is the same binary we have
-                return
-            response.status = 405  # not allowed, this artifact exists
+        if request.content_length < 0:
+            # without a length, we can't tell when the body has all arrived
+            response.status = 411  # length required
             return
 
-        tempfile.tempdir = app.config['artifact-dir']
-        tmpdir = tempfile.mkdtemp()
+        # read the body as it arrives, rather than letting bottle buffer it
+        response.status = store(cache_id, request.environ['wsgi.input'],
+                                request.content_length,
+                                request.get_header('X-Checksum', 'XYZ'))
+
+
+def authorised(password):
+    if app.config['password'] is 'insecure' or \
+            password != app.config['password']:
+        print 'Upload attempt: password fail'
+        app.config['last-reject'] = \
+            datetime.now().strftime('%y-%m-%d %H:%M:%S')
+        return False
+    return True
+
+
+def store(cache_id, stream, length, checksum):
+    '''Save the artifact read from stream, returning the HTTP status.
+
+    If length is given, exactly that many bytes are read. The data is
+    written to disk, hashed and checked to be a tarfile in one pass as it
+    arrives, then compared with the checksum from the client, if any.
+
+    '''
+    if re.match('^[a-zA-Z0-9\.\-\_]*$', cache_id or '') is None:
+        return 400  # bad request, cache_id contains bad things
+
+    if os.path.isdir(os.path.join(app.config['artifact-dir'], cache_id)):
+        if cache.check(cache_id) == checksum:
+            return 777  # this is the same binary we have
+        return 405  # not allowed, this artifact exists
+
+    tempfile.tempdir = app.config['artifact-dir']
+    tmpdir = tempfile.mkdtemp()
+    try:
+        artifact = os.path.join(tmpdir, cache_id)
+        with open(artifact, 'wb') as f:
+            upload = Upload(stream, length, f)
+            valid = upload.verify()
+        if length is not None and upload.size != length:
+            app.log('UPLOAD', 'ERROR: upload was incomplete:', artifact)
+            shutil.rmtree(tmpdir)
+            return 400  # bad request, the body is shorter than it said
+        if not valid:
+            app.log('UPLOAD', 'ERROR: not a valid tarfile:', artifact)
+            raise IOError('%s is not a valid tarfile' % cache_id)
+        if checksum not in [None, 'XYZ', upload.md5.hexdigest()]:
+            app.log('UPLOAD', 'ERROR: checksum mismatch for', cache_id)
+            shutil.rmtree(tmpdir)
+            return 400  # bad request, this isn't what the client sent
+
+        with open(artifact + '.md5', "a") as f:
+            f.write(upload.md5.hexdigest())
+        shutil.move(tmpdir, os.path.join(app.config['artifact-dir'],
+                                         cache_id))
+        index.add(cache_id, upload.size, upload.md5.hexdigest())
+        app.config['last-upload'] = datetime.now()
+        uploaded.set()
+        return 201  # success!
+    except:
+        # something went wrong, clean up
+        import traceback
+        traceback.print_exc()
         try:
-            upload = request.files.get('file')
-            artifact = os.path.join(tmpdir, cache_id)
+            shutil.rmtree(tmpdir)
+        except:
+            pass
+        return 500
+
+
+def upstream_headers(cache_id):
+    '''Return the length and checksum upstream-url gives for an artifact, or
+    None if it doesn't have it, or can't be reached.'''
+
+    try:
+        response = cache.kbas_session().head(
+            app.config['upstream-url'] + 'get/' + cache_id,
+            timeout=float(app.config.get('timeout', 60)))
+    except requests.exceptions.RequestException:
+        app.log('UPSTREAM', 'WARNING: unable to reach',
+                app.config['upstream-url'])
+        return None
+    if response.status_code != 200:
+        return None
+    length = response.headers.get('Content-Length')
+    return (int(length) if length else None,
+            response.headers.get('X-Checksum'))
+
+
+class Fetch(object):
+
+    ''' a download of an artifact from upstream-url into the artifact-dir,
+        which requests are served from while it arrives
+
+        There is only one Fetch for an artifact at a time in each process,
+        and a lockfile makes a Fetch in any other process (eg gunicorn
+        workers) follow that download rather than start another one. '''
 
+    def __init__(self, cache_id):
+        self.cache_id = cache_id
+        self.path = os.path.join(app.config['artifact-dir'], cache_id)
+        self.url = app.config['upstream-url'] + 'get/' + cache_id
+        self.length = None
+        self.checksum = None
+        self.partial = None
+        self.ready = threading.Event()  # partial is known, or never will be
+        self.done = threading.Event()
+
+    @staticmethod
+    def start(cache_id):
+        '''Return the Fetch for cache_id, starting it if need be, once it
+        has something to serve. If partial is None, it doesn't.'''
+
+        with fetching_lock:
+            fetch = fetching.get(cache_id)
+            if fetch is None:
+                fetch = fetching[cache_id] = Fetch(cache_id)
+                thread = threading.Thread(target=fetch.run)
+                thread.daemon = True
+                thread.start()
+        fetch.ready.wait()
+        return fetch
+
+    def run(self):
+        lock = None
+        locked = False
+        tmpdir = None
+        try:
+            found = upstream_headers(self.cache_id)
+            if not found:
+                return
+            self.length, self.checksum = found
+
+            lock = open(self.path + '.lock', 'a+')
             try:
-                upload.save(artifact)
-            except:
-                # upload.save is only available in recent versions of bottle
-                # troves (for example) have an older version... hence:
-                with open(artifact, "w") as f:
-                    f.write(upload.value)
-
-            if call(['tar', 'tf', artifact]):
-                app.log('UPLOAD', 'ERROR: not a valid tarfile:', artifact)
-                raise
-            checksum = cache.md5(artifact)
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                if self.follow(lock):
+                    return
+            locked = True
+            if os.path.isdir(self.path):
+                return  # it arrived before we got the lock
+
+            # we hold the lock, so a download named in it must have died
+            lock.seek(0)
+            stale = lock.read().strip()
+            if stale:
+                shutil.rmtree(stale, ignore_errors=True)
+            tempfile.tempdir = app.config['artifact-dir']
+            tmpdir = tempfile.mkdtemp()
+            lock.truncate(0)
+            lock.write(tmpdir)
+            lock.flush()
+            artifact = os.path.join(tmpdir, self.cache_id)
+            open(artifact, 'wb').close()
+            self.partial = artifact
+            self.ready.set()
+
+            checksum = cache.download(self.cache_id, self.url, artifact)
+            if not checksum:
+                raise IOError('download of %s failed' % self.url)
             with open(artifact + '.md5', "a") as f:
                 f.write(checksum)
-            shutil.move(tmpdir, os.path.join(app.config['artifact-dir'],
-                                             cache_id))
-            response.status = 201  # success!
-            app.config['last-upload'] = datetime.now()
-            return
+            # os.rename won't replace an artifact which has just been uploaded
+            os.rename(tmpdir, self.path)
+            index.add(self.cache_id, os.path.getsize(
+                os.path.join(self.path, self.cache_id)), checksum)
+            app.log('UPSTREAM', 'Fetched', self.cache_id)
+        except requests.exceptions.RequestException:
+            app.log('UPSTREAM', 'WARNING: failed fetching %s from' %
+                    self.cache_id, app.config['upstream-url'])
         except:
-            # something went wrong, clean up
             import traceback
             traceback.print_exc()
+            app.log('UPSTREAM', 'WARNING: failed fetching', self.cache_id)
+        finally:
+            if tmpdir:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+            if locked:
+                # anyone still waiting on the lockfile checks for the artifact
+                lock.truncate(0)
+                try:
+                    os.remove(self.path + '.lock')
+                except OSError:
+                    pass
+            if lock:
+                lock.close()
+            with fetching_lock:
+                fetching.pop(self.cache_id)
+            self.ready.set()
+            self.done.set()
+
+    def follow(self, lock):
+        '''Serve the download another process has locked, returning True
+        when it has finished, or False if we get the lock first.'''
+
+        while True:
+            lock.seek(0)
+            tmpdir = lock.read().strip()
+            artifact = os.path.join(tmpdir, self.cache_id)
+            if tmpdir and os.path.isfile(artifact):
+                self.partial = artifact
+                self.ready.set()
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                return True
             try:
-                shutil.rmtree(tmpdir)
-            except:
-                pass
-            response.status = 500
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return False
+            except IOError:
+                sleep(0.1)
 
+    def serve(self):
+        '''Return the partial artifact as the response to this request,
+        sending each part as it arrives.'''
+
+        offset = 0
+        ranged = re.match('^bytes=(\d+)-$', request.get_header('Range', ''))
+        if ranged and self.length is not None:
+            offset = min(int(ranged.group(1)), self.length)
+            response.status = 206
+            response.set_header('Content-Range', 'bytes %s-%s/%s' % (
+                offset, self.length - 1, self.length))
+        if self.length is not None:
+            response.set_header('Content-Length', str(self.length - offset))
+        if self.checksum:
+            response.set_header('X-Checksum', self.checksum)
+        response.content_type = 'application/octet-stream'
+        return self.read(open(self.partial, 'rb'), offset)
+
+    def read(self, f, offset):
+        # the file stays readable after the download is moved into place,
+        # or removed if it fails
+        with f:
+            f.seek(offset)
+            while True:
+                finished = self.done.is_set()
+                data = f.read(1024 * 1024)
+                if data:
+                    yield data
+                elif finished:
+                    return
+                else:
+                    self.done.wait(0.1)
+
+
+def cull_forever():
+    '''Cull every cull-interval seconds, and after each upload.'''
+
+    while True:
+        try:
+            cull()
+        except:
+            import traceback
+            traceback.print_exc()
+        uploaded.wait(app.config.get('cull-interval', 60))
+        uploaded.clear()
+
+
+def cull():
+    '''Remove the least recently used artifacts, until they take no more
+    than max-gigabytes and there are at least min-free-gigabytes free.
+
+    Artifacts named in any of the pinned-manifests are never removed.
+
+    '''
+    artifact_dir = app.config['artifact-dir']
+    excess = 0
+    if app.config.get('max-gigabytes'):
+        excess = index.size() - app.config['max-gigabytes'] * 1000000000
+    if app.config.get('min-free-gigabytes'):
+        stat = os.statvfs(artifact_dir)
+        free = stat.f_frsize * stat.f_bavail
+        excess = max(excess,
+                     app.config['min-free-gigabytes'] * 1000000000 - free)
+    if excess <= 0:
         return
 
+    keep = pinned()
+    deleted = 0
+    for key, size in index.least_recently_used():
+        if excess <= 0:
+            break
+        if key in keep:
+            continue
+        # move it out of the way first, so it's never served half-deleted
+        tempfile.tempdir = artifact_dir
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.rename(os.path.join(artifact_dir, key),
+                      os.path.join(tmpdir, key))
+        except OSError as e:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            if e.errno != errno.ENOENT:
+                app.log('CULL', 'WARNING: unable to remove', key)
+                continue
+            # it's gone already, so it only needs to leave the index
+        index.remove(key)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        excess -= size
+        deleted += 1
+    if deleted:
+        app.log('CULL', 'Removed %s artifacts from' % deleted, artifact_dir)
+    if excess > 0:
+        app.log('CULL', 'WARNING: pinned artifacts are over budget by',
+                '%sGB' % (excess / 1000000000))
+
+
+def pinned():
+    '''Return the set of cache keys named in the pinned-manifests.'''
+
+    keys = set()
+    for manifest in app.config.get('pinned-manifests', []):
+        try:
+            with open(manifest) as f:
+                keys.update(re.findall('[a-zA-Z0-9\.\-\_\+]+\.[0-9a-f]{64}',
+                                       f.read()))
+        except IOError:
+            app.log('CULL', 'WARNING: can not read pinned manifest',
+                    manifest)
+    return keys
+
+
+class Upload(object):
+
+    ''' a file-like view of an upload, which writes it to disk and hashes
+        it as it is read, so it can be checked as a tarfile in the same pass
+        '''
+
+    def __init__(self, stream, length, f):
+        self.stream = stream
+        self.remaining = length
+        self.f = f
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.tar = None
+        self.buffer = ''
+        self.offset = 0
+
+    def read(self, size=-1):
+        if self.offset >= len(self.buffer):
+            self.buffer = self._receive()
+            self.offset = 0
+        if size < 0:
+            size = len(self.buffer)
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def _receive(self):
+        size = 1024 * 1024
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+        chunk = self.stream.read(size) if size else ''
+        if self.remaining is not None:
+            self.remaining -= len(chunk)
+        self.f.write(chunk)
+        self.md5.update(chunk)
+        if self.tar:
+            try:
+                self.tar.stdin.write(chunk)
+            except IOError:
+                pass  # tar has given up, and will say so when it exits
+        self.size += len(chunk)
+        return chunk
+
+    def verify(self):
+        '''Read the whole upload, returning True if it's a valid tarfile.
+
+        tarfile can't read zstd, so those are piped through tar instead.
+        tarfile doesn't check gzip trailers either, so gzip is decompressed
+        by Gunzip, which does.
+
+        '''
+        self.read(0)
+        if utils.magic_format(self.buffer) == 'zstd':
+            self.tar = Popen(utils.tar_command('-', None, 'zstd'),
+                             stdin=PIPE, stdout=open(os.devnull, 'w'))
+            try:
+                self.tar.stdin.write(self.buffer)
+                while self.read():
+                    pass
+                self.tar.stdin.close()
+            except IOError:
+                pass
+            return self.tar.wait() == 0
+
+        valid = True
+        gunzip = None
+        try:
+            if utils.magic_format(self.buffer) == 'gzip':
+                gunzip = Gunzip(self)
+                archive = tarfile.open(fileobj=gunzip, mode='r|')
+            else:
+                archive = tarfile.open(fileobj=self, mode='r|*')
+            for member in archive:
+                pass
+            # tarfile stops at the first bad header, so anything after the
+            # last member must be the zeros which end the archive
+            while True:
+                block = archive.fileobj.read(1024 * 1024)
+                if not block:
+                    break
+                if block.strip('\0'):
+                    valid = False
+            if gunzip and not gunzip.complete():
+                valid = False
+        except (tarfile.TarError, IOError, EOFError, zlib.error):
+            valid = False
+        while self.read():
+            pass
+        return valid
+
+
+class Gunzip(object):
+
+    ''' a file-like view of the data decompressed from a gzip stream. zlib
+        checks the CRC and length in each member's trailer as it arrives,
+        and complete() says whether the last one arrived at all '''
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.member = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.crc = 0
+        self.length = 0
+        self.tail = ''
+        self.buffer = ''
+        self.offset = 0
+
+    def read(self, size=-1):
+        while self.offset >= len(self.buffer):
+            chunk = self.raw.read(1024 * 1024)
+            if not chunk:
+                return ''
+            self.tail = (self.tail + chunk)[-8:]
+            self.buffer = self._decompress(chunk)
+            self.offset = 0
+        if size < 0:
+            size = len(self.buffer)
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def _decompress(self, data):
+        output = self.member.decompress(data)
+        self.crc = zlib.crc32(output, self.crc)
+        self.length += len(output)
+        if self.member.unused_data:
+            # that member has ended, so what follows is the next one
+            data = self.member.unused_data
+            self.member = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self.crc = 0
+            self.length = 0
+            output += self._decompress(data)
+        return output
+
+    def complete(self):
+        '''Return True if the stream ended with the last member's trailer.'''
+
+        return self.tail == struct.pack('<II', self.crc & 0xffffffff,
+                                        self.length & 0xffffffff)
+
+
+class ThreadedWSGIRefServer(ServerAdapter):
+
+    ''' bottle's wsgiref server, but serving each request in a thread, so
+        a slow upload doesn't hold up everything else '''
+
+    def run(self, handler):
+        from wsgiref.simple_server import make_server, WSGIServer
+        from wsgiref.simple_server import WSGIRequestHandler
+        from SocketServer import ThreadingMixIn
+
+        class Server(ThreadingMixIn, WSGIServer):
+            daemon_threads = True
+
+        quiet = self.quiet
+
+        class Handler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                if not quiet:
+                    WSGIRequestHandler.log_request(self, *args, **kwargs)
+
+        make_server(self.host, self.port, handler, server_class=Server,
+                    handler_class=Handler).serve_forever()
+
 
 KeyedBinaryArtifactServer().__init__()
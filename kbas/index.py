@@ -0,0 +1,152 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Index of the artifacts kbas is serving.
+
+This is a single sqlite file in the artifact-dir, so listings and counts
+don't need to stat every artifact. It is kept up to date as artifacts are
+uploaded and removed, and anything missing from it is added at startup.
+
+'''
+
+import contextlib
+import os
+import sqlite3
+import time
+
+from ybd import app
+
+columns = ('key TEXT PRIMARY KEY, size INTEGER, checksum TEXT, '
+           'uploaded REAL, accessed REAL')
+
+
+@contextlib.contextmanager
+def connect():
+    '''Open the index, yielding a connection that commits on success.'''
+
+    db = sqlite3.connect(os.path.join(app.config['artifact-dir'], 'kbas.db'),
+                         timeout=float(app.config.get('timeout', 60)))
+    db.text_factory = str
+    try:
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS artifacts (%s)' % columns)
+            yield db
+    finally:
+        db.close()
+
+
+def add(key, size, checksum, uploaded=None, accessed=None):
+    '''Record an artifact, which has just been uploaded unless we're told
+    otherwise.'''
+
+    uploaded = uploaded or time.time()
+    with connect() as db:
+        db.execute('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?)',
+                   (key, size, checksum, uploaded, accessed or uploaded))
+
+
+def remove(key):
+    with connect() as db:
+        db.execute('DELETE FROM artifacts WHERE key = ?', (key,))
+
+
+def find(prefix='', offset=0, limit=1000):
+    '''Return (key, size, checksum, uploaded, accessed) for artifacts whose
+    key starts with prefix, most recently used first.'''
+
+    with connect() as db:
+        return db.execute('SELECT * FROM artifacts WHERE key GLOB ? '
+                          'ORDER BY accessed DESC LIMIT ? OFFSET ?',
+                          (prefix + '*', limit, offset)).fetchall()
+
+
+def count():
+    with connect() as db:
+        return db.execute('SELECT count(*) FROM artifacts').fetchone()[0]
+
+
+def size():
+    '''Return the total size in bytes of the artifacts.'''
+
+    with connect() as db:
+        return db.execute('SELECT total(size) FROM artifacts').fetchone()[0]
+
+
+def touch(key, checksum=None):
+    '''Record that an artifact has just been used, and its checksum if the
+    index doesn't have it yet.'''
+
+    with connect() as db:
+        db.execute('UPDATE artifacts SET accessed = ?, '
+                   'checksum = coalesce(checksum, ?) WHERE key = ?',
+                   (time.time(), checksum, key))
+
+
+def lookup(keys):
+    '''Return a dict of (size, checksum) for each of keys in the index.'''
+
+    result = {}
+    with connect() as db:
+        # sqlite allows at most 999 parameters in a query
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            for key, size, checksum in db.execute(
+                    'SELECT key, size, checksum FROM artifacts WHERE key IN '
+                    '(%s)' % ', '.join('?' * len(batch)), batch):
+                result[key] = size, checksum
+    return result
+
+
+def least_recently_used():
+    '''Return (key, size) for every artifact, least recently used first.'''
+
+    with connect() as db:
+        return db.execute('SELECT key, size FROM artifacts '
+                          'ORDER BY accessed').fetchall()
+
+
+def bootstrap():
+    '''Bring the index up to date with the artifact-dir.
+
+    Artifacts which aren't in the index are added, using their .md5 file
+    if there is one - checksums aren't computed here, since that would mean
+    reading every artifact. Entries for artifacts which have gone are
+    dropped.
+
+    '''
+    artifact_dir = app.config['artifact-dir']
+    with connect() as db:
+        known = set(row[0] for row in db.execute('SELECT key FROM artifacts'))
+        found = set()
+        for key in os.listdir(artifact_dir):
+            artifact = os.path.join(artifact_dir, key, key)
+            if not os.path.isfile(artifact):
+                continue
+            found.add(key)
+            if key in known:
+                continue
+            checksum = None
+            if os.path.isfile(artifact + '.md5'):
+                with open(artifact + '.md5') as f:
+                    checksum = f.read()
+            stat = os.stat(artifact)
+            db.execute('INSERT INTO artifacts VALUES (?, ?, ?, ?, ?)',
+                       (key, stat.st_size, checksum, stat.st_mtime,
+                        max(stat.st_atime, stat.st_mtime)))
+        db.executemany('DELETE FROM artifacts WHERE key = ?',
+                       [(key,) for key in known - found])
+    app.log('INDEX', 'Artifacts added to index:', len(found - known))
+    app.log('INDEX', 'Artifacts removed from index:', len(known - found))
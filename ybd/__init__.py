@@ -16,9 +16,11 @@
 import app
 import assembly
 import cache
+import db
 import defaults
 import definitions
 import deployment
 import repos
 import sandbox
+import scheduler
 import utils
@@ -20,13 +20,15 @@
 import os
 import sys
 import fcntl
+import tempfile
 import app
-from assembly import compose
 from deployment import deploy
 from definitions import Definitions
 import cache
+import repos
 import sandbox
 import sandboxlib
+import scheduler
 
 
 print('')
@@ -50,7 +52,9 @@ with app.timer('TOTAL'):
     with app.timer('DEFINITIONS', 'parsing %s' % app.config['def-version']):
         defs = Definitions()
     with app.timer('CACHE-KEYS', 'cache-key calculations'):
+        repos.get_trees(defs, app.config['target'])
         cache.cache_key(defs, app.config['target'])
+    cache.save_keys()
 
     cache.cull(app.config['artifacts'])
     target = defs.get(app.config['target'])
@@ -64,6 +68,7 @@ with app.timer('TOTAL'):
             f.write(target['cache'] + '\n')
         app.log('RESULT', 'Cache-key for target is at',
                 app.config['result-file'])
+        cache.touch_artifacts()
         os._exit(0)
 
     sandbox.executor = sandboxlib.executor_for_platform()
@@ -72,23 +77,24 @@ with app.timer('TOTAL'):
         app.log(app.config['target'], 'WARNING: using chroot is less safe ' +
                 'than using linux-user-chroot')
 
-    if 'instances' in app.config:
-        app.spawn()
+    if app.config.get('sandbox-templates'):
+        # shared by all the workers, and removed at the end of the run
+        app.config['templates'] = tempfile.mkdtemp(prefix='templates.',
+                                                   dir=app.config['tmp'])
 
-    while True:
-        try:
-            compose(defs, target)
-            break
-        except KeyboardInterrupt:
-            app.log(target, 'Interrupted by user')
-            os._exit(1)
-        except app.RetryException:
-            pass
-        except:
-            import traceback
-            traceback.print_exc()
-            app.log(target, 'Exiting: uncaught exception')
-            os._exit(1)
+    try:
+        scheduler.run(defs, target)
+    except KeyboardInterrupt:
+        app.log(target, 'Interrupted by user')
+        os._exit(1)
+    except:
+        import traceback
+        traceback.print_exc()
+        app.log(target, 'Exiting: uncaught exception')
+        os._exit(1)
+    cache.touch_artifacts()
+    if app.config.get('templates'):
+        app.remove_dir(app.config['templates'])
 
     if app.config.get('reproduce'):
         app.log('REPRODUCED',
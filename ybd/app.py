@@ -24,6 +24,7 @@ import warnings
 import yaml
 from multiprocessing import cpu_count, Process, Value, Lock
 from subprocess import call, check_output
+from distutils.spawn import find_executable
 import platform
 import hashlib
 from fs.osfs import OSFS  # not used here, but we import it to check install
@@ -47,9 +48,14 @@ class RetryException(Exception):
         if config.get('last-retry-time'):
             wait = datetime.datetime.now() - config.get('last-retry-time')
             if wait.seconds < 1:
-                with open(lockfile(defs, component), 'r') as l:
-                    call(['flock', '--shared', '--timeout',
-                          config.get('timeout', '60'), str(l.fileno())])
+                try:
+                    with open(lockfile(defs, component), 'r') as l:
+                        call(['flock', '--shared', '--timeout',
+                              config.get('timeout', '60'), str(l.fileno())])
+                except IOError:
+                    # whoever held the lock has finished and removed it, eg
+                    # the prefetcher, so there's nothing to wait for
+                    pass
                 log(component, 'Finished wait loop', verbose=True)
         config['last-retry-time'] = datetime.datetime.now()
         config['last-retry-component'] = component
@@ -210,10 +216,21 @@ def setup(args):
         # based on some testing (mainly on AWS), maximum effective
         # max-jobs value seems to be around 8-10 if we have enough cores
         # users should set values based on workload and build infrastructure
+        # max-jobs is shared out between the builds the scheduler is running
         # FIXME: more testing :)
         if cpu_count() >= 10:
             config['instances'] = 1 + (cpu_count() / 10)
-            config['max-jobs'] = cpu_count() / config['instances']
+
+    compression = config.get('artifact-compression', 'gzip')
+    if compression not in ['gzip', 'pigz', 'zstd']:
+        exit('SETUP', 'ERROR: unknown artifact-compression', compression)
+    if compression == 'pigz' and not find_executable('pigz'):
+        log('SETUP', 'WARNING: pigz not found, using gzip for artifacts')
+        config['artifact-compression'] = 'gzip'
+    if compression == 'zstd' and not find_executable('zstd'):
+        # zstd changes the cache-keys, so there's nothing to fall back to
+        exit('SETUP', 'ERROR: artifact-compression is zstd, but zstd is not '
+             'installed', '')
 
     config['pid'] = os.getpid()
     config['counter'] = Counter()
@@ -309,11 +326,3 @@ def elapsed(starttime):
     hours, remainder = divmod(int(td.total_seconds()), 60*60)
     minutes, seconds = divmod(remainder, 60)
     return "%02d:%02d:%02d" % (hours, minutes, seconds)
-
-
-def spawn():
-    for fork in range(1, config.get('instances')):
-        if os.fork() == 0:
-            config['fork'] = fork
-            log('FORKS', 'I am fork', config.get('fork'))
-            break
@@ -15,7 +15,6 @@
 # =*= License: GPL-2 =*=
 
 import os
-import random
 from subprocess import call, check_output
 import contextlib
 import fcntl
@@ -25,6 +24,7 @@ import json
 from app import config, chdir, exit, timer, elapsed
 from app import log, log_riemann, lockfile, RetryException
 from cache import cache, cache_key, get_cache, get_remote
+import db
 import repos
 import sandbox
 from shutil import copyfile
@@ -63,9 +63,7 @@ def compose(defs, target):
         return None
 
     # Create composite components (strata, systems, clusters)
-    systems = component.get('systems', [])
-    shuffle(systems)
-    for system in systems:
+    for system in component.get('systems', []):
         compose(defs, system['path'])
         for subsystem in system.get('subsystems', []):
             compose(defs, subsystem)
@@ -86,7 +84,6 @@ def install_contents(defs, component, contents=None):
 
     log(component, 'Installing contents\n', contents, verbose=True)
 
-    shuffle(contents)
     for it in contents:
         this = defs.get(it)
         if os.path.exists(os.path.join(component['sandbox'],
@@ -128,11 +125,9 @@ def install_dependencies(defs, component, dependencies=None):
         dependencies = component.get('build-depends', [])
 
     log(component, 'Installing dependencies\n', dependencies, verbose=True)
-    shuffle(dependencies)
     for it in dependencies:
         dependency = defs.get(it)
-        if os.path.exists(os.path.join(component['sandbox'], 'baserock',
-                                       dependency['name'] + '.meta')):
+        if sandbox.installed(component, dependency):
             # dependency has already been installed
             log(component, 'Already did', dependency['name'], verbose=True)
             continue
@@ -158,7 +153,10 @@ def build(defs, component):
 
     with claim(defs, component):
         if component.get('kind', 'chunk') == 'chunk':
+            if config.get('staging') == 'overlay' or config.get('templates'):
+                component['layers'] = []
             install_dependencies(defs, component)
+            sandbox.mount_layers(component)
         with timer(component, 'build of %s' % component['cache']):
             run_build(defs, component)
 
@@ -204,11 +202,10 @@ def run_build(defs, this):
         logfile.write('Elapsed_time: %s\n' % time_elapsed)
         log_riemann(this, 'Artifact_Timer', this['name'], time_elapsed)
 
-
-def shuffle(contents):
-    if config.get('instances', 1) > 1:
-        random.seed(datetime.datetime.now())
-        random.shuffle(contents)
+    seconds = (datetime.datetime.now() - this['start-time']).total_seconds()
+    with db.connect() as timings:
+        timings.execute('INSERT OR REPLACE INTO timings VALUES (?, ?, ?, ?)',
+                        (this['name'], this['cache'], seconds, time.time()))
 
 
 @contextlib.contextmanager
@@ -20,15 +20,29 @@ import hashlib
 import json
 import os
 import shutil
+import stat
 import sys
-from subprocess import call
+from subprocess import call, Popen, PIPE
 
 import app
-from repos import get_repo_url, get_tree
+import db
+from repos import get_repo_url, get_tree, is_sha1
 import utils
 import tempfile
 import yaml
-from StringIO import StringIO
+
+# digests of definitions mapped to their cache-keys, see definition_digest()
+known_keys = None
+new_keys = {}
+config_digest = None
+
+# artifacts known to be in the cache this run, and directories to be touched
+# by touch_artifacts() so cull() can tell which were used recently
+present = {}
+accessed = set()
+
+# see kbas_session()
+session = None
 
 
 def cache_key(defs, this):
@@ -49,11 +63,16 @@ def cache_key(defs, this):
 
     key = 'no-build'
     if app.config.get('mode', 'normal') in ['keys-only', 'normal']:
-        if definition.get('repo') and not definition.get('tree'):
-            definition['tree'] = get_tree(definition)
-        factors = hash_factors(defs, definition)
-        factors = json.dumps(factors, sort_keys=True).encode('utf-8')
-        key = hashlib.sha256(factors).hexdigest()
+        digest = definition_digest(defs, definition)
+        key = get_known_keys().get(digest)
+        if key is None:
+            if definition.get('repo') and not definition.get('tree'):
+                definition['tree'] = get_tree(definition)
+            factors = hash_factors(defs, definition)
+            factors = json.dumps(factors, sort_keys=True).encode('utf-8')
+            key = hashlib.sha256(factors).hexdigest()
+            if digest:
+                new_keys[digest] = key
 
     definition['cache'] = definition['name'] + "." + key
 
@@ -72,26 +91,75 @@ def cache_key(defs, this):
     return definition['cache']
 
 
-def hash_factors(defs, definition):
-    hash_factors = {'arch': app.config['arch']}
+def definition_digest(defs, definition):
+    '''Return a digest of everything which determines definition's cache-key
 
-    for factor in definition.get('build-depends', []):
-        hash_factors[factor] = cache_key(defs, factor)
+    The digest covers the normalised definition, the cache-keys of its
+    dependencies, and the config and defaults used by hash_factors(). If
+    the digest matches one from a previous run, so does the cache-key, and
+    we can skip resolving the tree.
 
-    for factor in definition.get('contents', []):
-        hash_factors[factor.keys()[0]] = cache_key(defs, factor.keys()[0])
+    A ref which is not a sha1 may point somewhere else next time, so
+    definitions with such refs get no digest.
 
-    for factor in ['tree', 'submodules'] + defs.defaults.build_steps:
-        if definition.get(factor):
-            hash_factors[factor] = definition[factor]
+    '''
+    if definition.get('repo') and not is_sha1(definition.get('ref')):
+        return None
+
+    global config_digest
+    if config_digest is None:
+        # a new ybd may work out cache-keys differently, even without a new
+        # version, if this file has been changed locally
+        with open(os.path.splitext(__file__)[0] + '.py', 'rb') as f:
+            source = hashlib.sha256(f.read()).hexdigest()
+        factors = [app.config['arch'], app.config.get('artifact-version'),
+                   app.config.get('artifact-compression'),
+                   app.config.get('default-splits', []),
+                   defs.defaults.build_steps, defs.defaults.build_systems,
+                   app.config.get('my-version'), source]
+        factors = json.dumps(factors, sort_keys=True).encode('utf-8')
+        config_digest = hashlib.sha256(factors).hexdigest()
+
+    content = dict((k, v) for k, v in definition.items()
+                   if k not in ['cache', 'tree'])
+    factors = {'definition': content,
+               'dependencies': dependency_keys(defs, definition),
+               'config': config_digest}
+    factors = json.dumps(factors, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(factors).hexdigest()
+
+
+def get_known_keys():
+    global known_keys
+    if known_keys is None:
+        with db.connect() as keys:
+            known_keys = dict(keys.execute('SELECT digest, cache FROM keys'))
+    return known_keys
+
+
+def save_keys():
+    '''Record the cache-keys calculated on this run, for the next one.'''
+
+    if new_keys:
+        with db.connect() as keys:
+            keys.executemany('INSERT OR REPLACE INTO keys VALUES (?, ?)',
+                             new_keys.items())
+        get_known_keys().update(new_keys)
+        new_keys.clear()
 
-    if definition.get('kind') == 'system':
-        if app.config.get('default-splits', []) != []:
-            hash_factors['splits'] = app.config.get('default-splits')
+
+def dependency_keys(defs, definition):
+    keys = {}
+
+    for factor in definition.get('build-depends', []):
+        keys[factor] = cache_key(defs, factor)
+
+    for factor in definition.get('contents', []):
+        keys[factor.keys()[0]] = cache_key(defs, factor.keys()[0])
 
     def hash_system_recursively(system):
         factor = system.get('path', 'BROKEN')
-        hash_factors[factor] = cache_key(defs, factor)
+        keys[factor] = cache_key(defs, factor)
         for subsystem in system.get('subsystems', []):
             hash_system_recursively(subsystem)
 
@@ -99,6 +167,25 @@ def hash_factors(defs, definition):
         for system in definition.get('systems', []):
             hash_system_recursively(system)
 
+    return keys
+
+
+def hash_factors(defs, definition):
+    hash_factors = {'arch': app.config['arch']}
+    hash_factors.update(dependency_keys(defs, definition))
+
+    for factor in ['tree', 'submodules'] + defs.defaults.build_steps:
+        if definition.get(factor):
+            hash_factors[factor] = definition[factor]
+
+    if definition.get('kind') == 'system':
+        if app.config.get('default-splits', []) != []:
+            hash_factors['splits'] = app.config.get('default-splits')
+
+    if app.config.get('artifact-compression', 'gzip') == 'zstd':
+        # older versions of ybd can't unpack these, so give them new keys
+        hash_factors['artifact-compression'] = 'zstd'
+
     if app.config.get('artifact-version', False):
         hash_factors['artifact-version'] = app.config.get('artifact-version')
 
@@ -128,13 +215,12 @@ def cache(defs, this):
         utils.hardlink_all_files(this['install'], this['sandbox'])
         shutil.rmtree(this['install'])
         shutil.rmtree(this['build'])
-        utils.set_mtime_recursively(this['sandbox'])
-        utils.make_deterministic_tar_archive(cachefile, this['sandbox'])
-        shutil.move('%s.tar' % cachefile, cachefile)
+        utils.make_deterministic_archive(cachefile, this['sandbox'],
+                                         root_entry=True)
     else:
-        utils.set_mtime_recursively(this['install'])
-        utils.make_deterministic_gztar_archive(cachefile, this['install'])
-        shutil.move('%s.tar.gz' % cachefile, cachefile)
+        utils.make_deterministic_archive(
+            cachefile, this['install'],
+            app.config.get('artifact-compression', 'gzip'))
 
     app.config['counter'].increment()
 
@@ -171,11 +257,27 @@ def update_manifest(defs, this, manifest):
 
 def unpack(defs, this, tmpfile):
     unpackdir = tmpfile + '.unpacked'
-    os.makedirs(unpackdir)
-    if call(['tar', 'xf', tmpfile, '--directory', unpackdir]):
-        app.log(this, 'Problem unpacking', tmpfile)
-        shutil.rmtree(os.path.dirname(tmpfile))
-        return False
+    if os.path.isdir(unpackdir):
+        # this was unpacked while it was downloaded
+        if app.config.get('object-store'):
+            store_objects(unpackdir, tmpfile + '.manifest')
+        record_size(unpackdir, tmpfile)
+    elif app.config.get('lazy-unpack'):
+        # only check the artifact is sound, get_unpacked() will unpack it
+        with open(os.devnull, 'w') as devnull:
+            if call(utils.tar_command(tmpfile), stdout=devnull):
+                app.log(this, 'Problem unpacking', tmpfile)
+                shutil.rmtree(os.path.dirname(tmpfile))
+                return False
+    else:
+        os.makedirs(unpackdir)
+        if call(utils.tar_command(tmpfile, unpackdir)):
+            app.log(this, 'Problem unpacking', tmpfile)
+            shutil.rmtree(os.path.dirname(tmpfile))
+            return False
+        if app.config.get('object-store'):
+            store_objects(unpackdir, tmpfile + '.manifest')
+        record_size(unpackdir, tmpfile)
 
     try:
         path = os.path.join(app.config['artifacts'], cache_key(defs, this))
@@ -194,69 +296,175 @@ def unpack(defs, this, tmpfile):
         return False
 
 
+def store_objects(unpackdir, manifest):
+    '''Replace the files in unpackdir with hardlinks into the object store
+
+    Objects are named by the sha256 of their content plus the mode, owner
+    and mtime they are unpacked with, so identical files in all artifacts
+    are only stored once. The manifest lists the object for each file.
+
+    '''
+    with open(manifest, 'w') as m:
+        for dirname, dirnames, filenames in os.walk(unpackdir):
+            for filename in filenames:
+                path = os.path.join(dirname, filename)
+                st = os.lstat(path)
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+
+                digest = sha256(path)
+                name = os.path.join(digest[:2], '%s.%o.%s.%s.%s' % (
+                    digest, st.st_mode, st.st_uid, st.st_gid,
+                    int(st.st_mtime)))
+                obj = os.path.join(app.config['objects'], name)
+                try:
+                    if not os.path.isdir(os.path.dirname(obj)):
+                        os.makedirs(os.path.dirname(obj))
+                    if not os.path.exists(obj):
+                        os.link(path, obj)
+                    elif not os.path.samefile(path, obj):
+                        os.link(obj, path + '.object')
+                        os.rename(path + '.object', path)
+                except OSError:
+                    # eg too many links; this file just isn't shared
+                    continue
+                m.write('%s %s\n' % (name, os.path.relpath(path, unpackdir)))
+
+
+def drop_objects(manifest):
+    '''Remove objects which will not be needed once manifest's unpacked
+    directory has been deleted.'''
+
+    try:
+        # files hardlinked together in the artifact share one object, so
+        # each of them is a link this artifact holds to it
+        links = {}
+        with open(manifest) as m:
+            for line in m:
+                name = line.split()[0]
+                links[name] = links.get(name, 0) + 1
+        for name, count in links.items():
+            obj = os.path.join(app.config['objects'], name)
+            if os.path.exists(obj) and os.stat(obj).st_nlink <= 1 + count:
+                os.remove(obj)
+        os.remove(manifest)
+    except (IOError, OSError):
+        pass
+
+
 def upload(defs, this):
+    '''Send the artifact for this to kbas.
+
+    The artifact is streamed in the body of a PUT, falling back to the
+    original multipart POST for servers which don't support that.
+
+    '''
     cachefile = get_cache(defs, this)
+    checksum = md5(cachefile)
     url = app.config['kbas-url'] + 'upload'
-    params = {"filename": this['cache'],
-              "password": app.config['kbas-password'],
-              "checksum": md5(cachefile)}
-    with open(cachefile, 'rb') as f:
-        try:
-            response = requests.post(url=url, data=params, files={"file": f})
-            if response.status_code == 201:
-                app.log(this, 'Uploaded %s to' % this['cache'], url)
-                return
-            if response.status_code == 777:
-                app.log(this, 'Reproduced %s at' % md5(cachefile),
+    headers = {'X-Password': app.config['kbas-password'],
+               'X-Checksum': checksum,
+               'Content-Length': str(os.path.getsize(cachefile))}
+    try:
+        with open(cachefile, 'rb') as f:
+            response = requests.put(url=url + '/' + this['cache'],
+                                    headers=headers, data=f)
+        if response.status_code == 404:
+            params = {"filename": this['cache'],
+                      "password": app.config['kbas-password'],
+                      "checksum": checksum}
+            with open(cachefile, 'rb') as f:
+                response = requests.post(url=url, data=params,
+                                         files={"file": f})
+        if response.status_code == 201:
+            app.log(this, 'Uploaded %s to' % this['cache'], url)
+            return
+        if response.status_code == 777:
+            app.log(this, 'Reproduced %s at' % checksum, this['cache'])
+            app.config['reproduced'].append([checksum, this['cache']])
+            return
+        if response.status_code == 405:
+            # server has different md5 for this artifact
+            if this['kind'] == 'stratum' and app.config['reproduce']:
+                app.log('BIT-FOR-BIT',
+                        'WARNING: reproduction failed for',
                         this['cache'])
-                app.config['reproduced'].append([md5(cachefile),
-                                                 this['cache']])
-                return
-            if response.status_code == 405:
-                # server has different md5 for this artifact
-                if this['kind'] == 'stratum' and app.config['reproduce']:
-                    app.log('BIT-FOR-BIT',
-                            'WARNING: reproduction failed for',
-                            this['cache'])
-                app.log(this, 'Artifact server already has', this['cache'])
-                return
-            app.log(this, 'Artifact server problem:', response.status_code)
-        except:
-            pass
-        app.log(this, 'Failed to upload', this['cache'])
+            app.log(this, 'Artifact server already has', this['cache'])
+            return
+        app.log(this, 'Artifact server problem:', response.status_code)
+    except:
+        pass
+    app.log(this, 'Failed to upload', this['cache'])
 
 
 def get_cache(defs, this):
     ''' Check if a cached artifact exists for the hashed version of this. '''
 
-    if cache_key(defs, this) is False:
-        raise Exception("cache_key not found")
-        #return False
-
-    cachedir = os.path.join(app.config['artifacts'], cache_key(defs, this))
-    if os.path.isdir(cachedir):
-        call(['touch', cachedir])
-        artifact = os.path.join(cachedir, cache_key(defs, this))
-        unpackdir = artifact + '.unpacked'
-        if not os.path.isdir(unpackdir):
-            tempfile.tempdir = app.config['tmp']
-            tmpdir = tempfile.mkdtemp()
-            if call(['tar', 'xf', artifact, '--directory', tmpdir]):
-                app.log(this, 'Problem unpacking', artifact)
-
-                raise Exception("tar issue return false")
-                return False
-            try:
-                shutil.move(tmpdir, unpackdir)
-            except:
-                # corner case... if we are here ybd is multi-instance, this
-                # artifact was uploaded from somewhere, and more than one
-                # instance is attempting to unpack. another got there first
-                pass
-        return os.path.join(cachedir, cache_key(defs, this))
-
-    raise Exception("Fall back exception, cachedir '%s' doesn't exist"%cachedir)
-    return False
+    key = cache_key(defs, this)
+    if key is False:
+        return False
+
+    if key not in present:
+        cachedir = os.path.join(app.config['artifacts'], key)
+        if not os.path.isdir(cachedir):
+            return False
+        present[key] = os.path.join(cachedir, key)
+        accessed.add(cachedir)
+
+    return present[key]
+
+
+def touch_artifacts():
+    ''' Update the mtimes of all the artifacts accessed by this run. '''
+
+    for path in accessed:
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+    accessed.clear()
+
+
+def get_unpacked(defs, this):
+    ''' Return the unpacked directory for the artifact of this, unpacking
+    the artifact first if necessary. '''
+
+    artifact = get_cache(defs, this)
+    if artifact is False:
+        return False
+
+    unpackdir = artifact + '.unpacked'
+    if not os.path.isdir(unpackdir):
+        tempfile.tempdir = app.config['tmp']
+        tmpdir = tempfile.mkdtemp()
+        if call(utils.tar_command(artifact, tmpdir)):
+            app.log(this, 'Problem unpacking', artifact)
+            return False
+        if app.config.get('object-store'):
+            store_objects(tmpdir, artifact + '.manifest')
+        record_size(tmpdir, artifact)
+        try:
+            shutil.move(tmpdir, unpackdir)
+        except:
+            # corner case... if we are here ybd is multi-instance, this
+            # artifact was uploaded from somewhere, and more than one
+            # instance is attempting to unpack. another got there first
+            pass
+
+    accessed.add(unpackdir)
+    return unpackdir
+
+
+def record_size(unpackdir, artifact):
+    ''' Save the disk space used by unpackdir, for cull_unpacked(). '''
+
+    size = 0
+    for dirname, dirnames, filenames in os.walk(unpackdir):
+        for name in dirnames + filenames:
+            size += os.lstat(os.path.join(dirname, name)).st_blocks * 512
+    with open(artifact + '.size', 'w') as f:
+        f.write(str(size))
+    return size
 
 
 def get_remote(defs, this):
@@ -264,38 +472,152 @@ def get_remote(defs, this):
     if app.config.get('last-retry-component') == this or this.get('tried'):
         return False
 
-    if this.get('kind', 'chunk') != 'chunk':
+    if this.get('kind', 'chunk') not in app.config.get('kbas-kinds',
+                                                       ['chunk']):
         return False
 
-    try:
-        this['tried'] = True  # let's not keep asking for this artifact
-        app.log(this, 'Try downloading', cache_key(defs, this))
-        url = app.config['kbas-url'] + 'get/' + cache_key(defs, this)
-        response = requests.get(url=url, stream=True)
-    except:
-        app.config.pop('kbas-url')
-        app.log(this, 'WARNING: remote artifact server is not working')
+    # the prefetcher's threads may have given up on kbas meanwhile
+    kbas_url = app.config.get('kbas-url')
+    if not kbas_url:
         return False
 
-    if response.status_code == 200:
-        try:
-            tempfile.tempdir = app.config['tmp']
-            tmpdir = tempfile.mkdtemp()
-            cachefile = os.path.join(tmpdir, cache_key(defs, this))
-            with open(cachefile, 'wb') as f:
-                shutil.copyfileobj(StringIO(response.content), f)
+    this['tried'] = True  # let's not keep asking for this artifact
+    app.log(this, 'Try downloading', cache_key(defs, this))
+    url = kbas_url + 'get/' + cache_key(defs, this)
+    tempfile.tempdir = app.config['tmp']
+    tmpdir = tempfile.mkdtemp()
+    cachefile = os.path.join(tmpdir, cache_key(defs, this))
+    unpackdir = None
+    if not app.config.get('lazy-unpack'):
+        unpackdir = cachefile + '.unpacked'
 
+    try:
+        if download(this, url, cachefile, unpackdir):
             return unpack(defs, this, cachefile)
+    except requests.exceptions.ReadTimeout:
+        # eg a kbas proxy slowly fetching from its upstream, so kbas is
+        # still worth asking for other artifacts
+        app.log(this, 'WARNING: timed out downloading', cache_key(defs, this))
+    except requests.exceptions.RequestException:
+        app.config.pop('kbas-url', None)
+        app.log(this, 'WARNING: remote artifact server is not working')
+    except:
+        app.log(this, 'WARNING: failed downloading', cache_key(defs, this))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return False
 
-        except:
-            app.log(this, 'WARNING: failed downloading', cache_key(defs, this))
 
-    return False
+def download(this, url, filename, unpackdir=None, retries=3):
+    ''' Stream url into filename, resuming if the connection drops.
+
+    If unpackdir is given the artifact is also unpacked there as it arrives.
+    Returns the md5 of the artifact if the whole of it arrived and matches
+    the X-Checksum from the server, False if the server doesn't have it.
+
+    '''
+    checksum = hashlib.md5()
+    expected = None
+    size = 0
+    tar = None
+    f = open(filename, 'wb')
+    try:
+        while True:
+            headers = {'Range': 'bytes=%s-' % size} if size else {}
+            try:
+                response = kbas_session().get(
+                    url, headers=headers, stream=True,
+                    timeout=float(app.config.get('timeout', 60)))
+                if response.status_code not in [200, 206]:
+                    return False
+                if size and response.status_code != 206:
+                    app.log(this, 'WARNING: server can not resume', url)
+                    return False
+                expected = response.headers.get('X-Checksum', expected)
+
+                for chunk in response.iter_content(1024 * 1024):
+                    if unpackdir and tar is None:
+                        os.makedirs(unpackdir)
+                        command = utils.tar_command(
+                            '-', unpackdir, utils.magic_format(chunk))
+                        tar = Popen(command, stdin=PIPE)
+                    f.write(chunk)
+                    checksum.update(chunk)
+                    if tar:
+                        tar.stdin.write(chunk)
+                    size += len(chunk)
+                break
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout):
+                if retries == 0:
+                    raise
+                retries -= 1
+                app.log(this, 'WARNING: resuming download at %s bytes' % size)
+    finally:
+        f.close()
+        if tar:
+            tar.stdin.close()
+            unpacked = tar.wait() == 0
+
+    if tar and not unpacked:
+        app.log(this, 'Problem unpacking', filename)
+        return False
+    if expected and expected != checksum.hexdigest():
+        app.log(this, 'WARNING: checksum mismatch for', url)
+        return False
+    return checksum.hexdigest()
+
+
+def kbas_session():
+    ''' Return a requests session for kbas, keeping connections open for
+    kbas-connections downloads at once. '''
+
+    global session
+    if session is None or session.pid != os.getpid():
+        # connections can't be shared with the process we forked from
+        session = requests.Session()
+        connections = app.config.get('kbas-connections', 4)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=connections)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.pid = os.getpid()
+    return session
+
+
+def remote_artifacts(keys, url=None):
+    ''' Ask kbas (at kbas-url, unless url is given) which of keys it has, a
+    few hundred keys per request.
+
+    Returns a dict of the size and checksum of each of the keys which kbas
+    has, or None if it can't answer, eg because it's an older version
+    without the batch API.
+
+    '''
+    result = {}
+    # small enough for the request size limit of older kbas versions
+    for i in range(0, len(keys), 500):
+        try:
+            response = kbas_session().post(
+                (url or app.config['kbas-url']) + '1.0/artifacts',
+                json=keys[i:i + 500],
+                timeout=float(app.config.get('timeout', 60)))
+            if response.status_code != 200:
+                return None
+            result.update((key, info)
+                          for key, info in response.json().items()
+                          if info.get('present'))
+        except (requests.exceptions.RequestException, ValueError,
+                AttributeError):
+            return None
+    return result
 
 
 def cull(artifact_dir):
     tempfile.tempdir = app.config['tmp']
     deleted = 0
+    cull_unpacked(artifact_dir)
 
     def clear(deleted, artifact_dir):
         artifacts = utils.sorted_ls(artifact_dir)
@@ -309,12 +631,14 @@ def cull(artifact_dir):
                             artifact_dir)
                 return True
             path = os.path.join(artifact_dir, artifact)
-            if os.path.exists(os.path.join(path, artifact + '.unpacked')):
-                path = os.path.join(path, artifact + '.unpacked')
             if os.path.exists(path) and artifact not in app.config['keys']:
-                tmpdir = tempfile.mkdtemp()
-                shutil.move(path, os.path.join(tmpdir, 'to-delete'))
-                app.remove_dir(tmpdir)
+                if os.path.exists(os.path.join(path, artifact + '.unpacked')):
+                    remove_unpacked(os.path.join(path, artifact))
+                else:
+                    present.pop(artifact, None)
+                    tmpdir = tempfile.mkdtemp()
+                    shutil.move(path, os.path.join(tmpdir, 'to-delete'))
+                    app.remove_dir(tmpdir)
                 deleted += 1
         return False
 
@@ -333,6 +657,55 @@ def cull(artifact_dir):
                  app.config.get('min-gigabytes', 10))
 
 
+def cull_unpacked(artifact_dir):
+    ''' Remove the least recently used unpacked artifacts, until they take
+    less than unpacked-gigabytes. The tarballs are left in place. '''
+
+    if app.config.get('unpacked-gigabytes') is None:
+        return
+
+    unpacked = []
+    for name in os.listdir(artifact_dir):
+        artifact = os.path.join(artifact_dir, name, name)
+        try:
+            mtime = os.stat(artifact + '.unpacked').st_mtime
+        except OSError:
+            continue
+        try:
+            size = int(open(artifact + '.size').read())
+        except (IOError, ValueError):
+            size = record_size(artifact + '.unpacked', artifact)
+        unpacked.append((mtime, size, name, artifact))
+
+    total = sum(size for mtime, size, name, artifact in unpacked)
+    limit = app.config['unpacked-gigabytes'] * 1000000000
+    deleted = 0
+    for mtime, size, name, artifact in sorted(unpacked):
+        if total <= limit:
+            break
+        if name not in app.config['keys']:
+            remove_unpacked(artifact)
+            total -= size
+            deleted += 1
+    if deleted > 0:
+        app.log('SETUP', 'Culled %s unpacked artifacts in' % deleted,
+                artifact_dir)
+
+
+def remove_unpacked(artifact):
+    ''' Remove the unpacked directory of artifact, and its objects. '''
+
+    tempfile.tempdir = app.config['tmp']
+    drop_objects(artifact + '.manifest')
+    tmpdir = tempfile.mkdtemp()
+    shutil.move(artifact + '.unpacked', os.path.join(tmpdir, 'to-delete'))
+    app.remove_dir(tmpdir)
+    try:
+        os.remove(artifact + '.size')
+    except OSError:
+        pass
+
+
 def check(artifact):
     try:
         artifact = os.path.join(app.config['artifact-dir'], artifact,
@@ -348,6 +721,14 @@ def check(artifact):
         return('================================')
 
 
+def sha256(filename):
+    hash = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hash.update(chunk)
+    return hash.hexdigest()
+
+
 def md5(filename):
     # From http://stackoverflow.com/questions/3431825
     # answer by http://stackoverflow.com/users/370483/quantumsoup
@@ -0,0 +1,52 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Local database for things ybd remembers from one run to the next.
+
+This is a single sqlite file in the ybd base directory, so it is safe for
+the scheduler's workers to write to it at the same time.
+
+'''
+
+import contextlib
+import os
+import sqlite3
+
+import app
+
+tables = {
+    'keys': 'digest TEXT PRIMARY KEY, cache TEXT',
+    'trees': 'repo TEXT, ref TEXT, tree TEXT, PRIMARY KEY (repo, ref)',
+    'timings': 'name TEXT, cache TEXT, seconds REAL, recorded REAL, '
+               'PRIMARY KEY (name, cache)',
+}
+
+
+@contextlib.contextmanager
+def connect():
+    '''Open the database, yielding a connection that commits on success.'''
+
+    db = sqlite3.connect(os.path.join(app.config['base'], 'ybd.db'),
+                         timeout=float(app.config.get('timeout', 60)))
+    db.text_factory = str
+    try:
+        with db:
+            for table, columns in tables.items():
+                db.execute('CREATE TABLE IF NOT EXISTS %s (%s)' %
+                           (table, columns))
+            yield db
+    finally:
+        db.close()
@@ -14,16 +14,30 @@
 #
 # =*= License: GPL-2 =*=
 
+import cPickle as pickle
+import glob
+import hashlib
 import json
 import yaml
 import os
+import tempfile
+from multiprocessing import Pool
+from subprocess import check_output
 from app import chdir, config, log, exit
 import cache
-from subprocess import check_output, PIPE
-import hashlib
+import db
 from defaults import Defaults
+from repos import get_repo_url, is_sha1
 import jsonschema
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# set by Definitions.parse_files(), for the worker processes
+schemas = {}
+
 
 # copied from http://stackoverflow.com/questions/21016220
 class ExplicitDumper(yaml.SafeDumper):
@@ -41,24 +55,19 @@ class Definitions(object):
         '''Load all definitions from a directory tree.'''
         self._data = {}
         self._trees = {}
-        self.defaults = Defaults()
+        self._names = {}
+        if not self._load_snapshot(directory):
+            self.defaults = Defaults()
+            self.parse_files(directory)
+            self._save_snapshot(directory)
         config['cpu'] = self.defaults.cpus.get(config['arch'], config['arch'])
-        self.parse_files(directory)
-        self._check_trees()
-
-        for path in self._data:
-            try:
-                this = self._data[path]
-                if this.get('ref') and self._trees.get(path):
-                    if this['ref'] == self._trees.get(path)[0]:
-                        this['tree'] = self._trees.get(path)[1]
-            except:
-                log('DEFINITIONS', 'WARNING: problem with .trees file')
-                pass
+        self._load_trees()
 
     def parse_files(self, directory):
+        global schemas
         schemas = self.load_schemas()
         with chdir(directory):
+            paths = []
             for dirname, dirnames, filenames in os.walk('.'):
                 filenames.sort()
                 dirnames.sort()
@@ -66,13 +75,21 @@ class Definitions(object):
                     dirnames.remove('.git')
                 for filename in filenames:
                     if filename.endswith(('.def', '.morph')):
-                        path = os.path.join(dirname, filename)
-                        data = self._load(path)
-                        if data is not None:
-                            self.validate_schema(schemas, data)
-                            data['path'] = path[2:]
-                            self._fix_keys(data)
-                            self._tidy_and_insert_recursively(data)
+                        paths.append(os.path.join(dirname, filename))
+
+            # parse in worker processes, but insert in order as they finish
+            pool = Pool()
+            try:
+                results = pool.imap(parse, paths, chunksize=8)
+                for index, (data, problems) in enumerate(results):
+                    self._report(problems)
+                    if data is not None:
+                        data['path'] = paths[index][2:]
+                        self._fix_keys(data)
+                        self._tidy_and_insert_recursively(data)
+            finally:
+                pool.close()
+                pool.join()
 
         if config.get('mode') == 'parse-only':
             with open(config['result-file'], 'w') as f:
@@ -87,42 +104,17 @@ class Definitions(object):
         return {x: self._load(config['schemas'][x])
                 for x in config.get('schemas')}
 
-    def validate_schema(self, schemas, data):
-        if schemas == {} or \
-                config.get('schema-validation', False) is False:
-            return
-        try:
-            jsonschema.validate(data, schemas[data.get('kind', None)])
-        except jsonschema.exceptions.ValidationError as e:
-            if config.get('schema-validation') == 'strict':
-                exit(data, 'ERROR: schema validation failed:\n', e)
-
-            log(data, 'WARNING: schema validation failed:')
-            print e
-
     def _load(self, path):
-        '''Load a single definition file as a dict.
-
-        The file is assumed to be yaml, and we insert the provided path into
-        the dict keyed as 'path'.
-
-        '''
-        try:
-            with open(path) as f:
-                text = f.read()
-            contents = yaml.safe_load(text)
-        except yaml.YAMLError, exc:
-            exit('DEFINITIONS', 'ERROR: could not parse %s' % path, exc)
-        except:
-            log('DEFINITIONS', 'WARNING: Unexpected error loading', path)
-            return None
-
-        if type(contents) is not dict:
-            log('DEFINITIONS', 'WARNING: %s contents is not dict:' % path,
-                str(contents)[0:50])
-            return None
+        contents, problems = load(path)
+        self._report(problems)
         return contents
 
+    def _report(self, problems):
+        for message, detail in problems:
+            if message.startswith('ERROR'):
+                exit('DEFINITIONS', message, detail)
+            log('DEFINITIONS', message, detail)
+
     def _tidy_and_insert_recursively(self, item):
         '''Insert a definition and its contents into the dictionary.
 
@@ -181,6 +173,7 @@ class Definitions(object):
             exit(item, 'ERROR: no path, no name?')
         item.setdefault('name', item['path'])
         item['name'] = item['name'].replace('/', '-')
+        self._names.setdefault(item['name'], item['path'])
         if item['name'] == config['target']:
             config['target'] = item['path']
 
@@ -230,47 +223,150 @@ class Definitions(object):
 
         return self._data.get(item.get('path', item.keys()[0]))
 
-    def _check_trees(self):
-        '''True if the .trees file matches the current working subdirectories
-
-        The .trees file lists all git trees for a set of definitions, and a
-        checksum of the checked-out subdirectories when we calculated them.
+    def _snapshot_key(self, directory):
+        '''Identify the definitions in directory, as parsed by this ybd
 
-        If the checksum for the current subdirectories matches, return True
+        The key covers the definitions commit, any uncommitted changes, and
+        ybd's own version and code, plus the config which affects parsing.
+        Returns None if directory is not a git checkout.
 
         '''
         try:
-            with chdir(config['defdir']):
-                checksum = check_output('ls -lRA */', shell=True)
-            checksum = hashlib.md5(checksum).hexdigest()
-            with open('.trees') as f:
-                text = f.read()
-            self._trees = yaml.safe_load(text)
-            if self._trees.get('.checksum') == checksum:
-                return True
+            with chdir(directory), open(os.devnull, 'w') as fnull:
+                commit = check_output(['git', 'rev-parse', 'HEAD'],
+                                      stderr=fnull)
+                dirty = check_output(['git', 'diff', 'HEAD'], stderr=fnull)
+                for path in check_output(['git', 'ls-files', '--others',
+                                          '--exclude-standard'],
+                                         stderr=fnull).splitlines():
+                    if path.endswith(('.def', '.morph', 'DEFAULTS')):
+                        with open(path) as f:
+                            dirty += path + f.read()
+        except:
+            return None
+
+        ybd = os.path.dirname(__file__)
+        key = hashlib.md5(commit + dirty + config['my-version'])
+        for path in sorted(glob.glob(os.path.join(ybd, '*.py')) +
+                           glob.glob(os.path.join(ybd, 'config', '*'))):
+            with open(path) as f:
+                key.update(f.read())
+        parsing = ['defaults', 'schemas', 'schema-validation']
+        key.update(json.dumps([config.get(x) for x in parsing]))
+        return key.hexdigest()
+
+    def _snapshot_file(self, directory):
+        checkout = hashlib.md5(os.path.abspath(directory)).hexdigest()
+        return os.path.join(config['base'], 'definitions.%s.pickle' % checkout)
+
+    def _load_snapshot(self, directory):
+        '''Load parsed definitions saved by a previous run, if still valid'''
+
+        if config.get('mode') == 'parse-only':
+            return False
+        try:
+            with open(self._snapshot_file(directory), 'rb') as f:
+                snapshot = pickle.load(f)
+            if snapshot['key'] != self._snapshot_key(directory):
+                return False
         except:
-            self._trees = {}
+            return False
+
+        self._data = snapshot['data']
+        self._names = snapshot['names']
+        self.defaults = snapshot['defaults']
+        config['target'] = self._names.get(config['target'], config['target'])
+        log('DEFINITIONS', 'Loaded %s definitions from' % len(self._data),
+            self._snapshot_file(directory))
+        return True
+
+    def _save_snapshot(self, directory):
+        key = self._snapshot_key(directory)
+        if key is None:
+            return
+        snapshot = {'key': key, 'data': self._data, 'names': self._names,
+                    'defaults': self.defaults}
+        with tempfile.NamedTemporaryFile(dir=config['base'],
+                                         delete=False) as f:
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(f.name, self._snapshot_file(directory))
+
+    def _load_trees(self):
+        '''Set the git tree for definitions whose repo and ref are known
 
-        return False
+        The trees index in ybd.db maps repo and ref to tree, one entry at a
+        time, so a change to definitions only means resolving trees for the
+        refs which have changed.
+
+        '''
+        with db.connect() as trees:
+            rows = trees.execute('SELECT repo, ref, tree FROM trees')
+            self._trees = dict(((repo, ref), tree) for repo, ref, tree in rows)
+
+        for this in self._data.values():
+            if this.get('repo') and this.get('ref'):
+                entry = (get_repo_url(this['repo']), this['ref'])
+                if self._trees.get(entry):
+                    this['tree'] = self._trees[entry]
 
     def save_trees(self):
-        '''Creates the .trees file for the current working directory
+        '''Add any newly resolved trees to the trees index
+
+        Only refs which are sha1s are recorded, since any other ref may point
+        to a different tree next time.
 
-        .trees contains a list of git trees for all the definitions, and a
-        checksum for the state of the working subdirectories
         '''
-        with chdir(config['defdir']):
-            try:
-                checksum = check_output('ls -lRA */', shell=True)
-            except:
-                checksum = check_output('ls -lRA .', shell=True)
-        checksum = hashlib.md5(checksum).hexdigest()
-        self._trees = {'.checksum': checksum}
-        for name in self._data:
-            if self._data[name].get('tree') is not None:
-                self._trees[name] = [self._data[name]['ref'],
-                                     self._data[name]['tree'],
-                                     self._data[name].get('cache')]
-
-        with open(os.path.join(os.getcwd(), '.trees'), 'w') as f:
-            f.write(yaml.safe_dump(self._trees, default_flow_style=False))
+        entries = {}
+        for this in self._data.values():
+            if this.get('tree') and this.get('repo') and is_sha1(this['ref']):
+                entry = (get_repo_url(this['repo']), this['ref'])
+                if self._trees.get(entry) != this['tree']:
+                    entries[entry] = this['tree']
+
+        if entries:
+            with db.connect() as trees:
+                trees.executemany('INSERT OR REPLACE INTO trees '
+                                  'VALUES (?, ?, ?)',
+                                  [k + (v,) for k, v in entries.items()])
+            self._trees.update(entries)
+
+
+def load(path):
+    '''Load a single definition file as a dict.
+
+    The file is assumed to be yaml. Returns the contents (or None), and a
+    list of (message, detail) for any problems. This runs in worker
+    processes, so it leaves logging (and exiting) to the caller.
+
+    '''
+    try:
+        with open(path) as f:
+            text = f.read()
+        contents = yaml.load(text, Loader=SafeLoader)
+    except yaml.YAMLError as exc:
+        return None, [('ERROR: could not parse %s' % path, str(exc))]
+    except:
+        return None, [('WARNING: Unexpected error loading', path)]
+
+    if type(contents) is not dict:
+        return None, [('WARNING: %s contents is not dict:' % path,
+                       str(contents)[0:50])]
+    return contents, []
+
+
+def parse(path):
+    '''Load a definition file, and validate it against the schemas.'''
+
+    contents, problems = load(path)
+    if contents is None or schemas == {} or \
+            config.get('schema-validation', False) is False:
+        return contents, problems
+    try:
+        jsonschema.validate(contents, schemas[contents.get('kind', None)])
+    except jsonschema.exceptions.ValidationError as e:
+        level = 'WARNING'
+        if config.get('schema-validation') == 'strict':
+            level = 'ERROR'
+        problems.append(('%s: schema validation failed for %s:\n' %
+                         (level, path), str(e)))
+    return contents, problems
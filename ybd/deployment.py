@@ -19,6 +19,7 @@ from subprocess import call
 import json
 import app
 import cache
+import utils
 import sandbox
 
 
@@ -46,9 +47,8 @@ def deploy_system(defs, system_spec, parent_location=''):
 
     with sandbox.setup(system):
         app.log(system, 'Extracting system artifact into', system['sandbox'])
-        with open(cache.get_cache(defs, system), 'r') as artifact:
-            call(['tar', 'x', '--directory', system['sandbox']],
-                 stdin=artifact)
+        call(utils.tar_command(cache.get_cache(defs, system),
+                               system['sandbox']))
 
         for subsystem in system_spec.get('subsystems', []):
             if deploy_defaults:
@@ -19,7 +19,8 @@ import json
 import re
 import shutil
 import string
-from subprocess import call, check_output, check_call
+from multiprocessing.pool import ThreadPool
+from subprocess import call, check_output, check_call, Popen, PIPE
 import sys
 
 import requests
@@ -62,6 +63,10 @@ def get_repo_name(repo):
     return ''.join([transl(x) for x in url])
 
 
+def is_sha1(ref):
+    return re.match('^[0-9a-f]{40}$', str(ref)) is not None
+
+
 def get_version(gitdir, ref='HEAD'):
     try:
         with app.chdir(gitdir), open(os.devnull, "w") as fnull:
@@ -79,11 +84,16 @@ def get_version(gitdir, ref='HEAD'):
     return result
 
 
+def get_gitdir(repo):
+    if repo.startswith('file://') or repo.startswith('/'):
+        return repo.replace('file://', '')
+    return os.path.join(app.config['gits'], get_repo_name(repo))
+
+
 def get_tree(this):
     ref = this['ref']
-    gitdir = os.path.join(app.config['gits'], get_repo_name(this['repo']))
+    gitdir = get_gitdir(this['repo'])
     if this['repo'].startswith('file://') or this['repo'].startswith('/'):
-        gitdir = this['repo'].replace('file://', '')
         if not os.path.isdir(gitdir):
             app.exit(this, 'ERROR: git repo not found:', this['repo'])
 
@@ -116,6 +126,84 @@ def get_tree(this):
             app.exit(this, 'ERROR: could not find tree for ref', (ref, gitdir))
 
 
+def get_trees(defs, target):
+    '''Resolve the trees for every repo and ref needed for target, in bulk.
+
+    Refs are grouped by mirror, and each mirror resolves all of its refs with
+    a single 'git cat-file --batch-check'. Mirrors we don't have yet are
+    fetched in parallel, unless the tree-server can tell us the trees. Any
+    ref which can't be resolved here is left for get_tree() to deal with.
+
+    '''
+    todo, seen, gitdirs = [target], set(), {}
+    while todo:
+        this = defs.get(todo.pop())
+        if this is None or this['path'] in seen or \
+                this.get('arch', app.config['arch']) != app.config['arch']:
+            continue
+        seen.add(this['path'])
+        if this.get('repo') and this.get('ref') and not this.get('tree'):
+            gitdirs.setdefault(get_gitdir(this['repo']), []).append(this)
+        todo += this.get('build-depends', []) + this.get('contents', [])
+        for system in this.get('systems', []):
+            todo += [system] + system.get('subsystems', [])
+
+    if gitdirs == {}:
+        return
+
+    pool = ThreadPool(app.config.get('fetch-jobs', 8))
+    missing = [x for x in gitdirs if not os.path.exists(x) and
+               x.startswith(app.config['gits'])]
+    if missing and app.config.get('tree-server'):
+        wanted = [this for gitdir in missing for this in gitdirs[gitdir]]
+        for this, tree in zip(wanted, pool.map(_tree_from_server, wanted)):
+            if tree:
+                this['tree'] = tree
+        missing = [x for x in missing
+                   if any(not this.get('tree') for this in gitdirs[x])]
+
+    pool.map(lambda x: mirror(gitdirs[x][0]['name'], gitdirs[x][0]['repo']),
+             missing)
+    pool.map(_resolve_trees, [gitdirs[x] for x in gitdirs
+                              if os.path.isdir(x)])
+    pool.close()
+
+
+def _tree_from_server(this):
+    try:
+        params = {'repo': get_repo_url(this['repo']), 'ref': this['ref']}
+        r = requests.get(url=app.config['tree-server'], params=params)
+        return r.json()['tree']
+    except:
+        app.log(this, 'WARNING: no tree from tree-server for', this['ref'])
+
+
+def _resolve_trees(components):
+    '''Set the tree for each of components, which all share a mirror.'''
+
+    todo = [this for this in components if not this.get('tree')]
+    gitdir = get_gitdir(todo[0]['repo']) if todo else None
+    for attempt in ['mirror', 'upstream']:
+        if todo == []:
+            return
+        if attempt == 'upstream':
+            app.log(todo[0], 'Fetching from upstream to resolve %s refs' %
+                    len(todo))
+            update_mirror(todo[0]['name'], todo[0]['repo'], gitdir)
+
+        refs = ''.join('%s^{tree}\n' % this['ref'] for this in todo)
+        with open(os.devnull, "w") as fnull:
+            batch = Popen(['git', 'cat-file', '--batch-check'], cwd=gitdir,
+                          stdin=PIPE, stdout=PIPE, stderr=fnull)
+            output = batch.communicate(refs)[0].splitlines()
+
+        for this, line in zip(list(todo), output):
+            fields = line.split()
+            if len(fields) == 3 and fields[1] == 'tree':
+                this['tree'] = fields[0]
+                todo.remove(this)
+
+
 def mirror(name, repo):
     tempfile.tempdir = app.config['tmp']
     tmpdir = tempfile.mkdtemp()
@@ -124,10 +212,11 @@ def mirror(name, repo):
         tar_file = get_repo_name(repo_url) + '.tar'
         app.log(name, 'Try fetching tarball %s' % tar_file)
         # try tarball first
-        with app.chdir(tmpdir), open(os.devnull, "w") as fnull:
-            call(['wget', os.path.join(app.config['tar-url'], tar_file)])
-            call(['tar', 'xf', tar_file], stderr=fnull)
-            os.remove(tar_file)
+        with open(os.devnull, "w") as fnull:
+            call(['wget', os.path.join(app.config['tar-url'], tar_file)],
+                 cwd=tmpdir)
+            call(['tar', 'xf', tar_file], stderr=fnull, cwd=tmpdir)
+            os.remove(os.path.join(tmpdir, tar_file))
             update_mirror(name, repo, tmpdir)
     except:
         app.log(name, 'Try git clone from', repo_url)
@@ -135,9 +224,8 @@ def mirror(name, repo):
             if call(['git', 'clone', '--mirror', '-n', repo_url, tmpdir]):
                 app.exit(name, 'ERROR: failed to clone', repo)
 
-    with app.chdir(tmpdir):
-        if call(['git', 'rev-parse']):
-            app.exit(name, 'ERROR: problem mirroring git repo at', tmpdir)
+    if call(['git', 'rev-parse'], cwd=tmpdir):
+        app.exit(name, 'ERROR: problem mirroring git repo at', tmpdir)
 
     gitdir = os.path.join(app.config['gits'], get_repo_name(repo))
     try:
@@ -159,11 +247,11 @@ def mirror_has_ref(gitdir, ref):
 
 
 def update_mirror(name, repo, gitdir):
-    with app.chdir(gitdir), open(os.devnull, "w") as fnull:
+    with open(os.devnull, "w") as fnull:
         app.log(name, 'Refreshing mirror for %s' % repo)
         repo_url = get_repo_url(repo)
         if call(['git', 'fetch', repo_url, '+refs/*:refs/*', '--prune'],
-                stdout=fnull, stderr=fnull):
+                stdout=fnull, stderr=fnull, cwd=gitdir):
             app.exit(name, 'ERROR: git update mirror failed', repo)
 
 
@@ -174,7 +262,8 @@ def checkout(this):
         if os.path.exists('.gitmodules') or this.get('submodules'):
             checkout_submodules(this)
 
-    utils.set_mtime_recursively(this['build'])
+    if app.config.get('normalise-mtimes', True):
+        utils.set_mtime_recursively(this['build'])
 
 
 def _checkout(name, repo, ref, checkout):
@@ -233,7 +322,8 @@ def extract_commit(name, repo, ref, target_dir):
             app.exit(name, 'ERROR: git checkout-index failed for', ref)
         app.log(name, 'Done', ref)
 
-    utils.set_mtime_recursively(target_dir)
+    if app.config.get('normalise-mtimes', True):
+        utils.set_mtime_recursively(target_dir)
 
 
 def checkout_submodules(this):
@@ -17,6 +17,7 @@
 
 import sandboxlib
 import contextlib
+import hashlib
 import os
 import pipes
 import shutil
@@ -34,6 +35,9 @@ from repos import get_repo_url
 # can be used.
 executor = None
 
+# overlayfs can't stack more lower directories than this
+max_layers = 500
+
 
 @contextlib.contextmanager
 def setup(this):
@@ -63,29 +67,162 @@ def setup(this):
         import traceback
         app.log(this, 'ERROR: surprise exception in sandbox', '')
         traceback.print_exc()
+        # app.exit() doesn't return, so the finally clause won't run
+        unmount_layers(this)
         app.exit(this, 'ERROR: sandbox debris is at', this['sandbox'])
     finally:
-        pass
+        unmount_layers(this)
 
     app.log(this, "Removing sandbox dir", this['sandbox'], verbose=True)
     app.remove_dir(this['sandbox'])
 
 
+def installed(this, component):
+    ''' Return True if component's artifact is already in this['sandbox']. '''
+
+    if component['cache'] + '.unpacked' in map(os.path.basename,
+                                               this.get('layers', [])):
+        return True
+    return os.path.exists(os.path.join(this['sandbox'], 'baserock',
+                                       component['name'] + '.meta'))
+
+
 def install(defs, this, component):
     # populate this['sandbox'] with the artifact files from component
-    if os.path.exists(os.path.join(this['sandbox'], 'baserock',
-                                   component['name'] + '.meta')):
+    if installed(this, component):
         return
     app.log(this, 'Sandbox: installing %s' % component['cache'], verbose=True)
-    if cache.get_cache(defs, component) is False:
+    unpackdir = cache.get_unpacked(defs, component)
+    if unpackdir is False:
         app.exit(this, 'ERROR: unable to get cache for', component['name'])
-    unpackdir = cache.get_cache(defs, component) + '.unpacked'
-    if this.get('kind') is 'system':
-        utils.copy_all_files(unpackdir, this['sandbox'])
+    if 'layers' in this:
+        # mount_layers() will do the rest
+        this['layers'].append(unpackdir)
+    elif this.get('kind') == 'system':
+        # systems are changed by system-integration commands, so they need
+        # copies rather than hardlinks. reflinks are copies which cost no
+        # time or space, if the filesystem has them
+        if utils.can_clone(app.config['artifacts'], app.config['tmp']):
+            utils.clone_all_files(unpackdir, this['sandbox'])
+        else:
+            utils.copy_all_files(unpackdir, this['sandbox'])
     else:
         utils.hardlink_all_files(unpackdir, this['sandbox'])
 
 
+def mount_layers(this):
+    ''' Stage the artifacts gathered in this['layers'] into the sandbox.
+
+    With staging: overlay, the layers are the read-only lower directories of
+    an overlay mounted on this['sandbox'], so staging takes the same time
+    however many there are. The existing contents of the sandbox become the
+    upper directory, which receives everything written during the build.
+    If the overlay can't be mounted, the layers are hardlinked instead.
+
+    With sandbox-templates, the layers are first combined into a template
+    which is shared by every build which needs the same layers.
+
+    '''
+    layers = this.pop('layers', [])
+    if not layers:
+        return
+
+    if app.config.get('templates'):
+        layers = [template(this, layers)]
+
+    if app.config.get('staging') == 'overlay':
+        if len(layers) <= max_layers and _mount_overlay(this, layers):
+            # nothing is staged file by file, so look for overlaps separately
+            if app.config.get('check-overlaps', 'ignore') != 'ignore':
+                app.config['new-overlaps'] += utils.symlink_overlaps(layers)
+            return
+        app.log(this, 'WARNING: no overlay, hardlinking layers')
+
+    for layer in layers:
+        utils.hardlink_all_files(layer, this['sandbox'])
+
+
+def template(this, layers):
+    ''' Return a directory with all of layers hardlinked into it, making it
+    unless an earlier build needed the same layers. '''
+
+    digest = hashlib.sha1('\n'.join(layers)).hexdigest()
+    path = os.path.join(app.config['templates'], digest)
+    if not os.path.isdir(path):
+        app.log(this, 'Making sandbox template from %s layers' % len(layers))
+        tmpdir = tempfile.mkdtemp(dir=app.config['templates'])
+        for layer in layers:
+            utils.hardlink_all_files(layer, tmpdir)
+        try:
+            os.rename(tmpdir, path)
+        except OSError:
+            # another instance made the same template first
+            shutil.rmtree(tmpdir)
+    return path
+
+
+def _mount_overlay(this, layers):
+    sandbox = this['sandbox']
+    links = sandbox + '.layers'
+    os.rename(sandbox, sandbox + '.upper')
+    for directory in [sandbox, sandbox + '.work', links]:
+        os.mkdir(directory)
+
+    # the mount options must fit in a page, so name the layers by number.
+    # the topmost layer is listed first, and it's the last one installed
+    for i, layer in enumerate(layers):
+        os.symlink(layer, os.path.join(links, str(i)))
+    options = 'lowerdir=%s,upperdir=%s,workdir=%s' % (
+        ':'.join(str(i) for i in reversed(range(len(layers)))),
+        sandbox + '.upper', sandbox + '.work')
+
+    if os.getuid() == 0:
+        command = ['mount', '-t', 'overlay', 'overlay', '-o', options, sandbox]
+    else:
+        command = ['fuse-overlayfs', '-o', options, sandbox]
+    with open(os.devnull, 'w') as fnull:
+        try:
+            mounted = call(command, cwd=links, stdout=fnull,
+                           stderr=fnull) == 0
+        except OSError:
+            mounted = False
+
+    if mounted:
+        this['overlay'] = True
+        app.log(this, 'Mounted %s layers on' % len(layers), sandbox,
+                verbose=True)
+    else:
+        os.rmdir(sandbox)
+        os.rename(sandbox + '.upper', sandbox)
+        _remove_layers(sandbox)
+    return mounted
+
+
+def unmount_layers(this):
+    ''' Unmount the overlay for this['sandbox'], if there is one. '''
+
+    if not this.pop('overlay', False):
+        return
+
+    sandbox = this['sandbox']
+    if os.getuid() == 0:
+        command = ['umount', sandbox]
+    else:
+        command = ['fusermount', '-u', sandbox]
+    if call(command):
+        app.log(this, 'WARNING: unable to unmount', sandbox)
+        return
+    os.rmdir(sandbox)
+    os.rename(sandbox + '.upper', sandbox)
+    _remove_layers(sandbox)
+
+
+def _remove_layers(sandbox):
+    for suffix in ['.work', '.layers']:
+        if os.path.isdir(sandbox + suffix):
+            shutil.rmtree(sandbox + suffix)
+
+
 def ldconfig(this):
     conf = os.path.join(this['sandbox'], 'etc', 'ld.so.conf')
     if os.path.exists(conf):
@@ -0,0 +1,313 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Schedule the builds needed for a target across a pool of workers.
+
+The dependency graph below the target is worked out once, from the parsed
+definitions. Components which kbas has are ready from the start, and what
+only they depend on is left out, since it won't be needed. Any other
+component is ready when everything it depends on is cached, and each ready
+component is composed in a forked worker process. The total max-jobs is
+shared out between the builds which are running.
+
+Ready components are started in order of the longest remaining path to the
+target, using how long each component took to build on previous runs.
+
+Meanwhile, a separate process downloads whatever it can from kbas, in the
+same order.
+
+'''
+
+import fcntl
+import heapq
+import os
+import signal
+import traceback
+from multiprocessing.pool import ThreadPool
+
+import app
+from app import config, log
+from assembly import compose
+from cache import cache_key, get_cache, get_remote, remote_artifacts
+from cache import touch_artifacts
+import db
+
+
+def dependencies(defs, component):
+    '''Return the paths of everything compose() needs before component.'''
+
+    deps = list(component.get('build-depends', []))
+    for it in component.get('contents', []):
+        content = defs.get(it)
+        if content.get('build-mode', 'staging') != 'bootstrap':
+            deps.append(content['path'])
+
+    def add_systems(systems):
+        for system in systems:
+            deps.append(system['path'])
+            add_systems(system.get('subsystems', []))
+
+    add_systems(component.get('systems', []))
+    return deps
+
+
+def graph(defs, target, available=()):
+    '''Map each component still to be composed to the ones it waits for.
+
+    Cached components, components for other arches, and anything which is
+    only needed by them, are left out. Components in available can be
+    downloaded from kbas, so they wait for nothing, and what they depend on
+    is left out unless something else needs it.
+
+    '''
+    result = {}
+    todo = [defs.get(target)['path']]
+    while todo:
+        path = todo.pop()
+        if path in result:
+            continue
+        component = defs.get(path)
+        if cache_key(defs, component) is False or get_cache(defs, component):
+            continue
+        if path in available:
+            result[path] = []
+            continue
+        result[path] = dependencies(defs, component)
+        todo += result[path]
+
+    for path in result:
+        result[path] = set(d for d in result[path] if d in result)
+    return result
+
+
+def downloadable(defs, paths):
+    '''Return the set of paths whose artifacts kbas has, or None if there's
+    no kbas or it can't say.'''
+
+    if not config.get('kbas-url') or config.get('reproduce'):
+        return None
+
+    kinds = config.get('kbas-kinds', ['chunk'])
+    paths = [path for path in paths
+             if defs.get(path).get('kind', 'chunk') in kinds]
+    if not paths:
+        return set()
+
+    keys = [defs.get(path)['cache'] for path in paths]
+    found = remote_artifacts(keys)
+    if found is None:
+        return None
+    return set(path for path, key in zip(paths, keys) if key in found)
+
+
+def durations(defs, paths):
+    '''Return the expected build time in seconds for each of paths.
+
+    Timings are looked up by name and cache-key, falling back to the most
+    recent timing for the name. Anything never built before is assumed to
+    take the average time.
+
+    '''
+    with db.connect() as timings:
+        rows = timings.execute('SELECT name, cache, seconds FROM timings '
+                               'ORDER BY recorded').fetchall()
+    by_key = {}
+    by_name = {}
+    for name, key, seconds in rows:
+        by_key[key] = by_name[name] = seconds
+
+    result = {}
+    for path in paths:
+        component = defs.get(path)
+        seconds = by_key.get(component['cache'],
+                             by_name.get(component['name']))
+        if seconds is not None:
+            result[path] = seconds
+
+    default = sum(result.values()) / max(1, len(result)) or 1
+    return dict((path, result.get(path, default)) for path in paths)
+
+
+def priorities(defs, waiting, dependents):
+    '''Return the length in seconds of the longest path from each component
+    to the target, so the scheduler can start the critical path first.'''
+
+    seconds = durations(defs, waiting)
+    result = {}
+
+    def longest(path):
+        if path not in result:
+            result[path] = seconds[path] + max(
+                [longest(d) for d in dependents.get(path, [])] or [0])
+        return result[path]
+
+    for path in waiting:
+        longest(path)
+    return result
+
+
+def run(defs, target):
+    '''Compose target, building independent components in parallel.'''
+
+    waiting = graph(defs, target)
+    available = downloadable(defs, waiting)
+    if available:
+        log('SCHEDULER', 'Artifacts available from kbas:', len(available))
+        waiting = graph(defs, target, available)
+    dependents = {}
+    for path, deps in waiting.items():
+        for dep in deps:
+            dependents.setdefault(dep, []).append(path)
+
+    rank = priorities(defs, waiting, dependents)
+    ready = []
+    for path in [p for p, deps in waiting.items() if not deps]:
+        heapq.heappush(ready, (-rank[path], path))
+        waiting.pop(path)
+
+    workers = config.get('instances', 1)
+    running = {}
+    failed = []
+    log('SCHEDULER', 'Components to compose:', len(ready) + len(waiting))
+    prefetcher = prefetch(defs, sorted(rank, key=lambda path: -rank[path]),
+                          available)
+    while running or (ready and not failed):
+        while ready and not failed and len(running) < workers:
+            path = heapq.heappop(ready)[1]
+            if get_cache(defs, path):
+                for it in _done(path, waiting, dependents):
+                    heapq.heappush(ready, (-rank[it], it))
+                continue
+            share = min(workers, len(running) + len(ready) + 1)
+            busy = set(slot for slot, it in running.values())
+            slot = min(set(range(1, workers + 1)) - busy)
+            running[_dispatch(defs, path, slot, share)] = slot, path
+
+        if not running:
+            continue
+        pid, status = os.wait()
+        if pid == prefetcher:
+            prefetcher = None
+        if pid not in running:
+            continue
+        slot, path = running.pop(pid)
+        if status != 0:
+            log(path, 'ERROR: worker %s failed, status' % slot, status)
+            failed.append(path)
+            continue
+        for it in _done(path, waiting, dependents):
+            heapq.heappush(ready, (-rank[it], it))
+
+    if prefetcher:
+        os.kill(prefetcher, signal.SIGTERM)
+        os.waitpid(prefetcher, 0)
+    if failed:
+        app.exit(target, 'ERROR: failed to compose', failed)
+    if waiting:
+        app.exit(target, 'ERROR: unable to schedule', sorted(waiting))
+
+
+def prefetch(defs, paths, available=None):
+    '''Fork a process to download artifacts for paths from kbas, in order,
+    while the workers build. Returns its pid, or None if there's no kbas.
+
+    Only the paths in available are tried, unless it's None because kbas
+    couldn't say what it has. They are downloaded kbas-connections at a
+    time. Anything which is already being built or downloaded is skipped.
+
+    '''
+    if not config.get('kbas-url') or config.get('reproduce'):
+        return None
+
+    kinds = config.get('kbas-kinds', ['chunk'])
+    paths = [path for path in paths
+             if defs.get(path).get('kind', 'chunk') in kinds and
+             (available is None or path in available)]
+    if not paths:
+        return None
+
+    pid = os.fork()
+    if pid != 0:
+        return pid
+
+    def fetch(path):
+        component = defs.get(path)
+        if not config.get('kbas-url'):
+            return
+        with open(app.lockfile(defs, component), 'a') as l:
+            try:
+                fcntl.flock(l, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return
+            try:
+                if not get_cache(defs, component):
+                    if get_remote(defs, component):
+                        config['counter'].increment()
+            finally:
+                try:
+                    os.remove(app.lockfile(defs, component))
+                except OSError:
+                    pass
+
+    try:
+        pool = ThreadPool(config.get('kbas-connections', 4))
+        pool.map(fetch, paths, chunksize=1)
+        touch_artifacts()
+    except KeyboardInterrupt:
+        os._exit(1)
+    except:
+        traceback.print_exc()
+        log('SCHEDULER', 'WARNING: prefetch failed')
+        os._exit(1)
+    os._exit(0)
+
+
+def _done(path, waiting, dependents):
+    '''Mark path as composed, returning the components it has made ready.'''
+
+    ready = []
+    for dependent in dependents.get(path, []):
+        waiting[dependent].discard(path)
+        if not waiting[dependent]:
+            ready.append(dependent)
+            waiting.pop(dependent)
+    return ready
+
+
+def _dispatch(defs, path, slot, share):
+    '''Fork a worker to compose path, with its share of max-jobs.'''
+
+    pid = os.fork()
+    if pid != 0:
+        return pid
+
+    config['fork'] = slot
+    config['max-jobs'] = max(1, config['max-jobs'] / share)
+    try:
+        while True:
+            try:
+                compose(defs, path)
+                break
+            except app.RetryException:
+                pass
+    except KeyboardInterrupt:
+        os._exit(1)
+    except:
+        traceback.print_exc()
+        log(path, 'Exiting: uncaught exception')
+        os._exit(1)
+    touch_artifacts()
+    os._exit(0)
@@ -15,7 +15,7 @@
 # =*= License: GPL-2 =*=
 
 from app import config, exit, log
-from cache import get_cache
+from cache import get_cache, get_unpacked
 import os
 import glob
 import re
@@ -100,15 +100,15 @@ def install_split_artifacts(defs, component, stratum, artifacts):
                         yaml.safe_dump(split_metadata, f,
                                        default_flow_style=False)
 
-                    cachepath, cachedir = os.path.split(get_cache(defs, chunk))
-                    path = os.path.join(cachepath, cachedir + '.unpacked')
+                    path = get_unpacked(defs, chunk)
                     utils.copy_file_list(path, component['sandbox'], filelist)
         except:
             # if we got here, something has gone badly wrong parsing metadata
             # or copying files into the sandbox...
             log(stratum, 'WARNING: failed copying files from', metafile)
             log(stratum, 'WARNING: copying *all* files')
-            utils.copy_all_files(path, component['sandbox'])
+            utils.copy_all_files(get_unpacked(defs, chunk),
+                                 component['sandbox'])
 
 
 def check_overlaps(defs, component):
@@ -153,7 +153,7 @@ def get_metadata(defs, component):
 def path_to_metafile(defs, component):
     ''' Return the path to metadata file for component. '''
 
-    return os.path.join(get_cache(defs, component) + '.unpacked', 'baserock',
+    return os.path.join(get_unpacked(defs, component), 'baserock',
                         component['name'] + '.meta')
 
 
@@ -15,50 +15,95 @@
 # =*= License: GPL-2 =*=
 
 import gzip
+import grp
 import tarfile
 import contextlib
+import ctypes
+import ctypes.util
+import errno
+import fcntl
 import os
+import pwd
 import shutil
 import stat
+import tempfile
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+from subprocess import Popen, PIPE
 from fs.osfs import OSFS
 from fs.multifs import MultiFS
 import calendar
 
 import app
 
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
 # The magic number for timestamps: 2011-11-11 11:11:11
 default_magic_timestamp = calendar.timegm([2011, 11, 11, 11, 11, 11])
 
+# from fcntl.h, for utimensat()
+AT_FDCWD = -100
+AT_SYMLINK_NOFOLLOW = 0x100
+
+# from linux/fs.h, the ioctl to reflink one file to another
+FICLONE = 0x40049409
+
+# which pairs of devices can_clone() has found support reflinks
+_clones = {}
+
 
 def set_mtime_recursively(root, set_time=default_magic_timestamp):
     '''Set the mtime for every file in a directory tree to the same.
 
-    The aim is to make builds more predictable.
+    The aim is to make builds more predictable. Symlinks are given the same
+    mtime too, rather than the mtime of their targets being set.
+
+    '''
+
+    for dirname, subdirs, basenames in os.walk(root.encode("utf-8")):
+        for basename in subdirs + basenames:
+            lutime(os.path.join(dirname, basename), set_time)
+    lutime(root, set_time)
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    _libc = None
+_utimensat = getattr(_libc, 'utimensat', None)
+_copy_file_range = getattr(_libc, 'copy_file_range', None)
+if _copy_file_range is not None:
+    _copy_file_range.restype = ctypes.c_ssize_t
+    _copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                 ctypes.c_void_p, ctypes.c_size_t,
+                                 ctypes.c_uint]
+
+
+def lutime(path, set_time):
+    '''Set the atime and mtime of path, without following symlinks.
+
+    Python's os.utime only ever modifies the target of a symlink. Where
+    libc has no utimensat, symlinks are left alone.
 
     '''
+    if _utimensat is None:
+        if not os.path.islink(path):
+            os.utime(path, (set_time, set_time))
+        return
 
-    for dirname, subdirs, basenames in os.walk(root.encode("utf-8"),
-                                               topdown=False):
-        for basename in basenames:
-            pathname = os.path.join(dirname, basename)
-
-            # Python's os.utime only ever modifies the timestamp
-            # of the target, it is not acceptable to set the timestamp
-            # of the target here, if we are staging the link target we
-            # will also set it's timestamp.
-            #
-            # We should however find a way to modify the actual link's
-            # timestamp, this outdated python bug report claims that
-            # it is impossible:
-            #
-            #   http://bugs.python.org/issue623782
-            #
-            # However, nowadays it is possible at least on gnuish systems
-            # with with the lutimes function.
-            if not os.path.islink(pathname):
-                os.utime(pathname, (set_time, set_time))
-
-        os.utime(dirname, (set_time, set_time))
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    times = (_timespec * 2)((int(set_time), 0), (int(set_time), 0))
+    if _utimensat(AT_FDCWD, path, times, AT_SYMLINK_NOFOLLOW):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), path)
 
 
 def copy_all_files(srcpath, destpath):
@@ -68,13 +113,7 @@ def copy_all_files(srcpath, destpath):
 
     '''
 
-    def _copyfun(inpath, outpath):
-        with open(inpath, "r") as infh:
-            with open(outpath, "w") as outfh:
-                shutil.copyfileobj(infh, outfh, 1024*1024*4)
-        shutil.copystat(inpath, outpath)
-
-    _process_tree(srcpath, destpath, _copyfun)
+    _process_tree(srcpath, destpath, copy_file)
 
 
 def hardlink_all_files(srcpath, destpath):
@@ -86,51 +125,206 @@ def hardlink_all_files(srcpath, destpath):
     _process_tree(srcpath, destpath, os.link)
 
 
+def clone_all_files(srcpath, destpath):
+    '''Reflink every file in the source path to the destination.
+
+    The copies share their data with the originals until either is changed,
+    so this is only possible if can_clone() is True for the two paths.
+
+    If an exception is raised, the staging-area is indeterminate.
+
+    '''
+    _process_tree(srcpath, destpath, clone_file)
+
+
+def can_clone(srcdir, destdir):
+    '''Return True if files in srcdir can be reflinked into destdir.'''
+
+    devices = (os.stat(srcdir).st_dev, os.stat(destdir).st_dev)
+    if devices not in _clones:
+        _clones[devices] = False
+        try:
+            with tempfile.NamedTemporaryFile(dir=srcdir) as src:
+                with tempfile.NamedTemporaryFile(dir=destdir) as dest:
+                    src.write('x')
+                    src.flush()
+                    fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+                    _clones[devices] = True
+        except (IOError, OSError):
+            pass
+    return _clones[devices]
+
+
+def clone_file(inpath, outpath):
+    '''Reflink a file, with its permissions and times.'''
+
+    fd = os.open(outpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with open(inpath, 'rb') as infh, os.fdopen(fd, 'wb') as outfh:
+        fcntl.ioctl(outfh.fileno(), FICLONE, infh.fileno())
+    shutil.copystat(inpath, outpath)
+
+
+def copy_file(inpath, outpath):
+    '''Copy a file with its permissions and times.
+
+    The data is copied by copy_file_range() where the kernel supports it, so
+    it never passes through python, and filesystems which can share extents
+    will do so.
+
+    '''
+    # never write into an existing file, which may be hardlinked elsewhere
+    fd = os.open(outpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with open(inpath, 'rb') as infh, os.fdopen(fd, 'wb') as outfh:
+        if not _copy_range(infh.fileno(), outfh.fileno()):
+            shutil.copyfileobj(infh, outfh, 1024*1024*4)
+    shutil.copystat(inpath, outpath)
+
+
+def _copy_range(infd, outfd):
+    '''Copy all of infd to outfd in the kernel, returning False if this is
+    not possible here, in which case nothing has been copied.'''
+
+    if _copy_file_range is None:
+        return False
+
+    copied = 0
+    while True:
+        result = _copy_file_range(infd, None, outfd, None, 1024*1024*1024, 0)
+        if result == 0:
+            return True
+        if result < 0:
+            error = ctypes.get_errno()
+            if copied == 0 and error in [errno.ENOSYS, errno.EXDEV,
+                                         errno.EINVAL, errno.EOPNOTSUPP]:
+                return False
+            raise OSError(error, os.strerror(error))
+        copied += result
+
+
 def _process_tree(srcpath, destpath, actionfunc):
-    file_stat = os.lstat(srcpath)
-    mode = file_stat.st_mode
-
-    if stat.S_ISDIR(mode):
-        # Ensure directory exists in destination, then recurse.
-        if not os.path.lexists(destpath):
-            os.makedirs(destpath)
-        dest_stat = os.stat(os.path.realpath(destpath))
-        if not stat.S_ISDIR(dest_stat.st_mode):
-            raise IOError('Destination not a directory. source has %s'
-                          ' destination has %s' % (srcpath, destpath))
-
-        for entry in os.listdir(srcpath):
-            _process_tree(os.path.join(srcpath, entry),
-                          os.path.join(destpath, entry),
-                          actionfunc)
-    elif stat.S_ISLNK(mode):
-        # Copy the symlink.
-        if os.path.lexists(destpath):
-            import re
-            path = re.search('/.*$', re.search('tmp[^/]+/.*$',
-                             destpath).group(0)).group(0)
-            app.config['new-overlaps'] += [path]
-            os.remove(destpath)
-        os.symlink(os.readlink(srcpath), destpath)
+    '''Recreate the tree at srcpath in destpath.
 
-    elif stat.S_ISREG(mode):
-        # Process the file.
-        if os.path.lexists(destpath):
+    Directories and symlinks are made while walking the tree, and files are
+    passed to actionfunc afterwards, by a pool of staging-jobs threads.
+
+    '''
+    files = []
+    if not os.path.lexists(destpath):
+        os.makedirs(destpath)
+    _walk_tree(srcpath, destpath, files)
+
+    jobs = app.config.get('staging-jobs', 8)
+    if jobs > 1 and len(files) > 100:
+        pool = ThreadPool(jobs)
+        try:
+            pool.map(lambda f: _process_file(actionfunc, *f), files,
+                     chunksize=64)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for f in files:
+            _process_file(actionfunc, *f)
+
+
+def _walk_tree(srcpath, destpath, files):
+    dest_stat = os.stat(destpath)
+    if not stat.S_ISDIR(dest_stat.st_mode):
+        raise IOError('Destination not a directory. source has %s'
+                      ' destination has %s' % (srcpath, destpath))
+
+    for name, mode in _list_dir(srcpath):
+        src = os.path.join(srcpath, name)
+        dest = os.path.join(destpath, name)
+
+        if stat.S_ISDIR(mode):
+            # Ensure directory exists in destination, then recurse.
+            try:
+                os.mkdir(dest)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            _walk_tree(src, dest, files)
+
+        elif stat.S_ISLNK(mode):
+            # Copy the symlink.
+            if os.path.lexists(dest):
+                import re
+                path = re.search('/.*$', re.search('tmp[^/]+/.*$',
+                                 dest).group(0)).group(0)
+                app.config['new-overlaps'] += [path]
+                os.remove(dest)
+            os.symlink(os.readlink(src), dest)
+
+        elif stat.S_ISREG(mode) or stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+            files.append((src, dest, mode))
+
+        else:
+            # Unsupported type.
+            raise IOError('Cannot extract %s into staging-area. Unsupported'
+                          ' type.' % src)
+
+
+def symlink_overlaps(layers):
+    '''Return the paths of symlinks in layers which replace something from an
+    earlier layer, as staging the layers in order would find them.'''
+
+    seen = set()
+    overlaps = []
+
+    def walk(layer, relpath):
+        for name, mode in _list_dir(os.path.join(layer, relpath)):
+            path = os.path.join(relpath, name)
+            if stat.S_ISLNK(mode) and path in seen:
+                overlaps.append('/' + path)
+            seen.add(path)
+            if stat.S_ISDIR(mode):
+                walk(layer, path)
+
+    for layer in layers:
+        walk(layer, '')
+    return overlaps
+
+
+def _list_dir(path):
+    '''Return the names and file types of the entries in path.'''
+
+    if scandir is not None:
+        result = []
+        for entry in scandir(path):
+            if entry.is_symlink():
+                result.append((entry.name, stat.S_IFLNK))
+            elif entry.is_dir(follow_symlinks=False):
+                result.append((entry.name, stat.S_IFDIR))
+            elif entry.is_file(follow_symlinks=False):
+                result.append((entry.name, stat.S_IFREG))
+            else:
+                result.append((entry.name,
+                               entry.stat(follow_symlinks=False).st_mode))
+        return result
+
+    return [(name, os.lstat(os.path.join(path, name)).st_mode)
+            for name in os.listdir(path)]
+
+
+def _process_file(actionfunc, srcpath, destpath, mode):
+    if stat.S_ISREG(mode):
+        try:
+            actionfunc(srcpath, destpath)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
             os.remove(destpath)
-        actionfunc(srcpath, destpath)
+            actionfunc(srcpath, destpath)
 
-    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+    else:
         # Block or character device. Put contents of st_dev in a mknod.
+        file_stat = os.lstat(srcpath)
         if os.path.lexists(destpath):
             os.remove(destpath)
         os.mknod(destpath, file_stat.st_mode, file_stat.st_rdev)
         os.chmod(destpath, file_stat.st_mode)
 
-    else:
-        # Unsupported type.
-        raise IOError('Cannot extract %s into staging-area. Unsupported'
-                      ' type.' % srcpath)
-
 
 def copy_file_list(srcpath, destpath, filelist):
     '''Copy every file in the source path to the destination.
@@ -139,13 +333,7 @@ def copy_file_list(srcpath, destpath, filelist):
 
     '''
 
-    def _copyfun(inpath, outpath):
-        with open(inpath, "r") as infh:
-            with open(outpath, "w") as outfh:
-                shutil.copyfileobj(infh, outfh, 1024*1024*4)
-        shutil.copystat(inpath, outpath)
-
-    _process_list(srcpath, destpath, filelist, _copyfun)
+    _process_list(srcpath, destpath, filelist, copy_file)
 
 
 def hardlink_file_list(srcpath, destpath, filelist):
@@ -227,58 +415,175 @@ def _process_list(srcdir, destdir, filelist, actionfunc):
                           ' type.' % srcpath)
 
 
-def make_deterministic_gztar_archive(base_name, root_dir, time=1321009871.0):
-    '''Make a gzipped tar archive of contents of 'root_dir'.
+def make_deterministic_archive(filename, root_dir, compression=None,
+                               root_entry=False):
+    '''Make a tar archive of the contents of root_dir, optionally compressed.
 
-    This function takes extra steps to ensure the output is deterministic,
-    compared to shutil.make_archive(). First, it sorts the results of
-    os.listdir() to ensure the ordering of the files in the archive is the
-    same. Second, it sets a fixed timestamp and filename in the gzip header.
+    The output is deterministic: entries are sorted, every mtime is set to
+    default_magic_timestamp, and gzip headers get a fixed timestamp and no
+    filename. With compression 'pigz' or 'zstd' the tar stream is piped
+    through that tool, so compression uses max-jobs threads. Neither tool
+    puts a name or timestamp in its output.
 
-    As well as fixing https://bugs.python.org/issue24465, to make this function
-    redundant we would need to patch shutil.make_archive() so we could manually
-    set the timestamp and filename set in the gzip file header.
+    If root_entry is set the archive includes './' for root_dir itself, so
+    unpacking it also sets the mode and owner of the target directory.
 
     '''
-    # It's hard to implement this function by monkeypatching
-    # shutil.make_archive() because of the way the tarfile module includes the
-    # filename of the tarfile in the gzip header. So we have to reimplement
-    # shutil.make_archive().
+    with open(filename, 'wb') as f:
+        if compression is None:
+            write_tar(f, root_dir, root_entry)
+        elif compression == 'gzip':
+            with gzip.GzipFile(filename='', mode='wb', fileobj=f,
+                               mtime=1321009871.0) as f_gzip:
+                write_tar(f_gzip, root_dir, root_entry)
+        else:
+            compressor = Popen(compress_command(compression), stdin=PIPE,
+                               stdout=f)
+            try:
+                write_tar(compressor.stdin, root_dir, root_entry)
+            finally:
+                compressor.stdin.close()
+            if compressor.wait():
+                raise IOError('%s failed compressing %s' %
+                              (compression, filename))
 
-    def add_directory_to_tarfile(f_tar, dir_name, dir_arcname):
-        for filename in sorted(os.listdir(dir_name)):
-            name = os.path.join(dir_name, filename)
-            arcname = os.path.join(dir_arcname, filename)
 
-            f_tar.add(name=name, arcname=arcname, recursive=False)
+def write_tar(f, root_dir, root_entry=False, time=default_magic_timestamp):
+    '''Write a GNU tar stream of root_dir to file object f.
 
-            if os.path.isdir(name) and not os.path.islink(name):
-                add_directory_to_tarfile(f_tar, name, arcname)
+    This does what tarfile.add() would, but only needs one lstat for each
+    entry, and sets the mtimes in the headers rather than on disk.
 
-    with open(base_name + '.tar.gz', 'wb') as f:
-        gzip_context = gzip.GzipFile(
-            filename='', mode='wb', fileobj=f, mtime=time)
-        with gzip_context as f_gzip:
-            with tarfile.TarFile(mode='w', fileobj=f_gzip) as f_tar:
-                add_directory_to_tarfile(f_tar, root_dir, '.')
+    '''
+    names = {}
+    hardlinks = {}
+
+    def owner(lookup, id):
+        if (lookup, id) not in names:
+            try:
+                names[(lookup, id)] = lookup(id)[0]
+            except KeyError:
+                names[(lookup, id)] = ''
+        return names[(lookup, id)]
+
+    def add(path, arcname):
+        st = os.lstat(path)
+        info = tarfile.TarInfo(arcname)
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.uid = st.st_uid
+        info.gid = st.st_gid
+        info.uname = owner(pwd.getpwuid, st.st_uid)
+        info.gname = owner(grp.getgrgid, st.st_gid)
+        info.mtime = time
+
+        inode = (st.st_ino, st.st_dev)
+        if stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+        elif inode in hardlinks:
+            info.type = tarfile.LNKTYPE
+            info.linkname = hardlinks[inode]
+        elif stat.S_ISREG(st.st_mode):
+            info.type = tarfile.REGTYPE
+            info.size = st.st_size
+        elif stat.S_ISLNK(st.st_mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(path)
+        elif stat.S_ISFIFO(st.st_mode):
+            info.type = tarfile.FIFOTYPE
+        elif stat.S_ISCHR(st.st_mode):
+            info.type = tarfile.CHRTYPE
+        elif stat.S_ISBLK(st.st_mode):
+            info.type = tarfile.BLKTYPE
+        else:
+            # sockets, which tarfile.add() skips too
+            return 0
+
+        if info.type in [tarfile.CHRTYPE, tarfile.BLKTYPE]:
+            info.devmajor = os.major(st.st_rdev)
+            info.devminor = os.minor(st.st_rdev)
+        if info.type != tarfile.DIRTYPE and st.st_nlink > 1:
+            hardlinks.setdefault(inode, arcname)
+
+        header = info.tobuf(tarfile.GNU_FORMAT)
+        f.write(header)
+        written = len(header)
+        if info.type == tarfile.REGTYPE:
+            # exactly the size in the header, raising if the file shrank
+            with open(path, 'rb') as data:
+                tarfile.copyfileobj(data, f, info.size)
+            padding = -info.size % tarfile.BLOCKSIZE
+            f.write(tarfile.NUL * padding)
+            written += info.size + padding
+
+        if info.type == tarfile.DIRTYPE:
+            for name in sorted(os.listdir(path)):
+                written += add(os.path.join(path, name),
+                               os.path.join(arcname, name))
+        return written
+
+    if root_entry:
+        written = add(root_dir, '.')
+    else:
+        written = sum(add(os.path.join(root_dir, name),
+                          os.path.join('.', name))
+                      for name in sorted(os.listdir(root_dir)))
 
+    # end of archive, padded to a whole record like tarfile.close()
+    written += tarfile.BLOCKSIZE * 2
+    padding = -written % tarfile.RECORDSIZE
+    f.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2 + padding))
 
-def make_deterministic_tar_archive(base_name, root_dir):
-    '''Make a tar archive of contents of 'root_dir'.
 
-    This function uses monkeypatching to make shutil.make_archive() create
-    a deterministic tarfile.
+def compress_command(compression):
+    '''Return the command to compress stdin to stdout with compression.'''
 
-    https://bugs.python.org/issue24465 will make this function redundant.
+    jobs = str(app.config.get('max-jobs', 1))
+    if compression == 'pigz':
+        return ['pigz', '-n', '-c', '-p', jobs]
+    if compression == 'zstd':
+        return ['zstd', '-q', '-c', '-T' + jobs]
+    raise ValueError('unknown artifact-compression %s' % compression)
 
-    '''
-    real_listdir = os.listdir
 
-    def stable_listdir(path):
-        return sorted(real_listdir(path))
+def archive_format(filename):
+    '''Return 'gzip', 'zstd' or None for an archive, by its magic bytes.'''
 
-    with monkeypatch(os, 'listdir', stable_listdir):
-        shutil.make_archive(base_name, 'tar', root_dir)
+    with open(filename, 'rb') as f:
+        return magic_format(f.read(4))
+
+
+def magic_format(magic):
+    '''Return the compression for an archive starting with magic.'''
+
+    if magic.startswith('\x1f\x8b'):
+        return 'gzip'
+    if magic.startswith('\x28\xb5\x2f\xfd'):
+        return 'zstd'
+    return None
+
+
+def tar_command(filename, directory=None, compression=False):
+    '''Return the command to unpack an archive into directory, or just to
+    list it if no directory is given, whatever its compression.
+
+    If filename is '-' the archive is read from stdin, and its compression
+    must be given since tar can't detect it from a pipe.
+
+    '''
+    if directory is None:
+        command = ['tar', 'tf', filename]
+    else:
+        command = ['tar', 'xf', filename, '--directory', directory]
+
+    if compression is False:
+        compression = archive_format(filename)
+    if compression == 'zstd':
+        command += ['--use-compress-program', 'zstd -d -q']
+    elif compression == 'gzip' and find_executable('pigz'):
+        command += ['--use-compress-program', 'pigz -d']
+    elif compression == 'gzip':
+        command += ['--gzip']
+    return command
 
 
 def _find_extensions(paths):